@@ -1,129 +1,329 @@
 import os
+import json
+import time
 import base64 # for base64 encoding/decoding
 import secrets # for generating secure random bytes
 import hashlib # for hashing
+import hmac # for constant-time comparison
+import config
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from datetime import datetime
 from database import database
+from app.logic import clear_session_caches, get_keyring
+from app.search import stop_search_index
 
 # KDF parameters
-KDF_ITERATIONS = 200_000  
-SALT_LENGTH = 16        
+KDF_ITERATIONS = 200_000  # used by records stored before parameters were kept per-record
+SALT_LENGTH = 16
 
-def _derive_key_from_password(password: str, salt: bytes) -> bytes:
+# Supported password KDFs (auth.kdf_algorithm)
+KDF_PBKDF2 = "pbkdf2"
+KDF_SCRYPT = "scrypt"
+
+# Calibration bounds: never go below the floor, whatever the machine
+PBKDF2_MIN_ITERATIONS = 100_000
+PBKDF2_PROBE_ITERATIONS = 20_000
+SCRYPT_MIN_LOG2_N = 14
+SCRYPT_MAX_LOG2_N = 20
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# An unlock outside [target / RECALIBRATE_FACTOR, target * RECALIBRATE_FACTOR] triggers recalibration
+RECALIBRATE_FACTOR = 2.0
+
+# Auth record formats (auth.format_version):
+# 1 = legacy: password_hash is the raw PBKDF2 output, which is also the KEK
+# 2 = one KDF run, split with HKDF into independent verifier and KEK subkeys
+AUTH_FORMAT_LEGACY = 1
+AUTH_FORMAT_SPLIT = 2
+AUTH_FORMAT_VERSION = AUTH_FORMAT_SPLIT
+
+def _run_kdf(password: str, salt: bytes, algorithm: str = KDF_PBKDF2, params: dict = None) -> bytes:
     """
-    Derive a key-encryption-key (KEK) from the given password + salt using PBKDF2-HMAC-SHA256.
+    Run the password KDF once with the given parameters and return the raw 32-byte output.
     """
-    # PBKDF2-HMAC-SHA256
-    dk = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt,
-        KDF_ITERATIONS,
-        dklen=32
-    )
+    params = params or {"iterations": KDF_ITERATIONS}
+    if algorithm == KDF_PBKDF2:
+        return hashlib.pbkdf2_hmac(
+            'sha256',
+            password.encode('utf-8'),
+            salt,
+            params["iterations"],
+            dklen=32
+        )
+    if algorithm == KDF_SCRYPT:
+        kdf = Scrypt(salt=salt, length=32, n=2 ** params["log2_n"], r=params["r"], p=params["p"])
+        return kdf.derive(password.encode('utf-8'))
+    raise ValueError(f"Unknown KDF algorithm: {algorithm}")
 
-    return base64.urlsafe_b64encode(dk)  # bytes
+def _time_kdf(algorithm: str, params: dict) -> float:
+    """
+    Return the wall-clock seconds one KDF run takes with the given parameters.
+    """
+    start = time.perf_counter()
+    _run_kdf("calibration", b"\0" * SALT_LENGTH, algorithm, params)
+    return time.perf_counter() - start
 
-def setup_master_password(password: str) -> bytes:
+def calibrate_kdf(algorithm: str = None, target_ms: int = None) -> dict:
     """
-    For the first run:
-    1. Generate a random salt.
-    2. Derive a key-encryption-key (KEK) from the password and salt.
-    3. Hash the password to generate a password hash.
-    4. Generate a random master key.
-    5. Encrypt the master key with the KEK.
-    6. Save the password hash, salt, and encrypted master key to the database.
-    """
-    # 1. Generate random salt
-    salt = secrets.token_bytes(SALT_LENGTH)
+    Measure this machine and pick KDF parameters so one derivation takes about target_ms.
+    Defaults come from config.KDF_ALGORITHM / config.KDF_TARGET_MS.
+    Returns the parameter dict to store alongside the auth record.
+    """
+    algorithm = algorithm or config.KDF_ALGORITHM
+    target = (target_ms or config.KDF_TARGET_MS) / 1000.0
 
-    # 2. KEK derivation from password and salt
-    kek = _derive_key_from_password(password, salt)
+    if algorithm == KDF_PBKDF2:
+        elapsed = max(_time_kdf(algorithm, {"iterations": PBKDF2_PROBE_ITERATIONS}), 1e-6)
+        iterations = int(PBKDF2_PROBE_ITERATIONS * target / elapsed)
+        # Round to a tidy number so small timing noise doesn't change the parameters
+        iterations = max(PBKDF2_MIN_ITERATIONS, iterations // 10_000 * 10_000)
+        return {"iterations": iterations}
 
-    # 3. Hash for password verification
-    pw_hash_raw = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, KDF_ITERATIONS)
-    password_hash = pw_hash_raw.hex()  # stringa hex per confronto
+    if algorithm == KDF_SCRYPT:
+        # Cost is linear in n: time the floor, then double while we stay under target
+        log2_n = SCRYPT_MIN_LOG2_N
+        elapsed = _time_kdf(algorithm, {"log2_n": log2_n, "r": SCRYPT_R, "p": SCRYPT_P})
+        while log2_n < SCRYPT_MAX_LOG2_N and elapsed * 2 <= target:
+            log2_n += 1
+            elapsed *= 2
+        return {"log2_n": log2_n, "r": SCRYPT_R, "p": SCRYPT_P}
 
-    # 4. Generate a random master key
-    master_key = Fernet.generate_key()  # bytes base64
+    raise ValueError(f"Unknown KDF algorithm: {algorithm}")
 
-    # 5. Encrypt the master key with the KEK
-    fernet_kek = Fernet(kek)
-    encrypted_master_key = fernet_kek.encrypt(master_key)  # bytes
+def _expand_subkey(dk: bytes, info: bytes) -> bytes:
+    """
+    Expand a 32-byte subkey from the KDF output, bound to the given purpose label.
+    """
+    return HKDFExpand(algorithm=hashes.SHA256(), length=32, info=info).derive(dk)
 
-    # 6. Save to database (auth table)
-    # Convert salt and encrypted master key to base64 for storage
-    salt_b64 = base64.urlsafe_b64encode(salt).decode('utf-8')
-    encrypted_master_b64 = encrypted_master_key.decode('utf-8')
+def _split_kdf_output(dk: bytes, format_version: int):
+    """
+    Turn one KDF output into (password_hash_hex, kek) for the given record format.
+    """
+    if format_version == AUTH_FORMAT_LEGACY:
+        return dk.hex(), base64.urlsafe_b64encode(dk)
+    verifier = _expand_subkey(dk, b"securenotes/auth/verifier")
+    kek = _expand_subkey(dk, b"securenotes/auth/kek")
+    return verifier.hex(), base64.urlsafe_b64encode(kek)
 
-    conn = database.create_connection()
-    if conn is None:
-        raise RuntimeError("Cannot connect to DB to save master key.")
-    cursor = conn.cursor()
+def _derive_key_from_password(password: str, salt: bytes,
+                              algorithm: str = KDF_PBKDF2, params: dict = None) -> bytes:
+    """
+    Derive a key-encryption-key (KEK) from the given password + salt
+    for the current auth record format.
+    """
+    _, kek = _split_kdf_output(_run_kdf(password, salt, algorithm, params), AUTH_FORMAT_VERSION)
+    return kek  # bytes
+
+def _save_auth_record(cursor, password_hash: str, salt_b64: str,
+                      encrypted_master_b64: str, format_version: int,
+                      kdf_algorithm: str, kdf_params: dict):
+    """
+    Insert or replace the single auth record.
+    """
+    params_json = json.dumps(kdf_params)
     cursor.execute("SELECT COUNT(*) FROM auth")
     count = cursor.fetchone()[0]
     if count == 0:
         cursor.execute(
-            "INSERT INTO auth (password_hash, salt, encrypted_master_key) VALUES (?, ?, ?)",
-            (password_hash, salt_b64, encrypted_master_b64)
+            """
+            INSERT INTO auth (password_hash, salt, encrypted_master_key, format_version, kdf_algorithm, kdf_params)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (password_hash, salt_b64, encrypted_master_b64, format_version, kdf_algorithm, params_json)
         )
     else:
         cursor.execute(
-            "UPDATE auth SET password_hash = ?, salt = ?, encrypted_master_key = ? WHERE id = ?",
-            (password_hash, salt_b64, encrypted_master_b64, 1)
+            """
+            UPDATE auth SET password_hash = ?, salt = ?, encrypted_master_key = ?, format_version = ?,
+                            kdf_algorithm = ?, kdf_params = ?
+            WHERE id = ?
+            """,
+            (password_hash, salt_b64, encrypted_master_b64, format_version, kdf_algorithm, params_json, 1)
         )
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+def _wrap_master_key(password: str, master_key: bytes, algorithm: str, params: dict):
+    """
+    Wrap master_key under a fresh salt with the given KDF settings.
+    Returns the arguments for _save_auth_record after the cursor.
+    """
+    salt = secrets.token_bytes(SALT_LENGTH)
+    dk = _run_kdf(password, salt, algorithm, params)
+    password_hash, kek = _split_kdf_output(dk, AUTH_FORMAT_VERSION)
+
+    encrypted_master_key = Fernet(kek).encrypt(master_key)  # bytes
+
+    # Convert salt and encrypted master key to base64 for storage
+    salt_b64 = base64.urlsafe_b64encode(salt).decode('utf-8')
+    encrypted_master_b64 = encrypted_master_key.decode('utf-8')
+    return password_hash, salt_b64, encrypted_master_b64, AUTH_FORMAT_VERSION, algorithm, params
+
+def _write_auth_record(password: str, master_key: bytes, algorithm: str, params: dict):
+    """
+    Wrap master_key under a fresh salt with the given KDF settings and store the auth record.
+    """
+    record = _wrap_master_key(password, master_key, algorithm, params)
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        _save_auth_record(cursor, *record)
+        cursor.close()
+
+def setup_master_password(password: str) -> bytes:
+    """
+    For the first run:
+    1. Calibrate the configured KDF for this machine.
+    2. Generate a random master key.
+    3. Generate a random salt, run the KDF once and split it into a password verifier
+       and a key-encryption-key (KEK).
+    4. Encrypt the master key with the KEK.
+    5. Save the verifier, salt, encrypted master key, record format and KDF parameters to the database.
+    """
+    # 1. Pick KDF parameters for this machine
+    algorithm = config.KDF_ALGORITHM
+    params = calibrate_kdf(algorithm)
+
+    # 2. Generate a random master key
+    master_key = Fernet.generate_key()  # bytes base64
+
+    # 3-5. Derive, wrap and store
+    _write_auth_record(password, master_key, algorithm, params)
 
     print("🔑 Master password set and master key generated.")
     return master_key
 
 def verify_master_password(password: str) -> bytes:
-    conn = database.create_connection()
+    """
+    Verify the password with a single KDF run and return the decrypted master key,
+    or None if the password is wrong.
+    On success the record is rewritten if it is in a legacy format, uses a different
+    KDF than configured, or took far from the target time to derive on this machine.
+    """
+    conn = database.get_connection()
     if conn is None:
         raise RuntimeError("Cannot connect to DB for authentication.")
     cursor = conn.cursor()
 
-    cursor.execute("SELECT password_hash, salt, encrypted_master_key FROM auth LIMIT 1")
+    cursor.execute("""
+        SELECT password_hash, salt, encrypted_master_key, format_version, kdf_algorithm, kdf_params
+        FROM auth LIMIT 1
+    """)
     row = cursor.fetchone()
     cursor.close()
-    conn.close()
 
     if not row:
         raise RuntimeError("No master password set. Call setup_master_password first.")
 
-    stored_hash_hex, salt_b64, encrypted_master_b64 = row
+    stored_hash_hex, salt_b64, encrypted_master_b64, format_version, algorithm, params_json = row
     salt = base64.urlsafe_b64decode(salt_b64.encode('utf-8'))
     encrypted_master_key = encrypted_master_b64.encode('utf-8')
+    algorithm = algorithm or KDF_PBKDF2
+    params = json.loads(params_json) if params_json else {"iterations": KDF_ITERATIONS}
 
-    pw_hash_raw = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, KDF_ITERATIONS)
-    if pw_hash_raw.hex() != stored_hash_hex:
+    start = time.perf_counter()
+    dk = _run_kdf(password, salt, algorithm, params)
+    elapsed = time.perf_counter() - start
+
+    password_hash, kek = _split_kdf_output(dk, format_version)
+    if not hmac.compare_digest(password_hash, stored_hash_hex):
         return None
 
-    kek = _derive_key_from_password(password, salt)
     fernet_kek = Fernet(kek)
     try:
         master_key = fernet_kek.decrypt(encrypted_master_key)
     except Exception as e:
         raise RuntimeError("Failed to decrypt master key: possibly corrupted data.") from e
 
+    _maybe_upgrade_auth_record(password, master_key, format_version, algorithm, params, elapsed)
+
     print("🔓 Master password verified and master key decrypted.")
     return master_key
 
+def _maybe_upgrade_auth_record(password: str, master_key: bytes, format_version: int,
+                               algorithm: str, params: dict, elapsed: float):
+    """
+    Re-derive and rewrap the master key with fresh parameters when the stored record
+    is outdated or its KDF cost has drifted away from the configured target.
+    """
+    target = config.KDF_TARGET_MS / 1000.0
+    current = format_version == AUTH_FORMAT_VERSION and algorithm == config.KDF_ALGORITHM
+    in_band = target / RECALIBRATE_FACTOR <= elapsed <= target * RECALIBRATE_FACTOR
+    if current and in_band:
+        return
+
+    new_params = calibrate_kdf(config.KDF_ALGORITHM)
+    if current and new_params == params:
+        # Already at the calibration bounds for this machine
+        return
+
+    _write_auth_record(password, master_key, config.KDF_ALGORITHM, new_params)
+    print(f"🔁 Auth record upgraded ({config.KDF_ALGORITHM}, {new_params}).")
+
+def rotate_master_key(password: str) -> bytes:
+    """
+    Replace the master key with a freshly generated one:
+    1. Verify the password and unwrap the current key.
+    2. Wrap the new key under the password (the slow KDF runs before any lock is taken).
+    3. In one transaction: store the old key wrapped under the new one in encryption_keys,
+       rewrap the index key, save the new auth record and bump auth.key_id.
+    Rows keep their key_id and stay readable through the keyring; app.rotation
+    rewraps their data keys under the new key afterwards. Blind indexes and the
+    persistent search index use the index key, which does not change.
+    Returns the new master key, or None if the password is wrong.
+    """
+    old_key = verify_master_password(password)
+    if old_key is None:
+        return None
+
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to DB for key rotation.")
+    algorithm, params_json = conn.execute("SELECT kdf_algorithm, kdf_params FROM auth LIMIT 1").fetchone()
+    params = json.loads(params_json) if params_json else calibrate_kdf(config.KDF_ALGORITHM)
+    new_key = Fernet.generate_key()
+    record = _wrap_master_key(password, new_key, algorithm or config.KDF_ALGORITHM, params)
+
+    # Pin the old key's keyring (current = old ID) so callers still holding the
+    # old key can keep reading; their writes are refused by check_current_key
+    index_key = get_keyring(old_key).index_key
+    with database.transaction(immediate=True) as conn:
+        old_id = conn.execute("SELECT key_id FROM auth LIMIT 1").fetchone()[0]
+        conn.execute(
+            "INSERT INTO encryption_keys (id, key_data) VALUES (?, ?)",
+            (old_id, Fernet(new_key).encrypt(old_key).decode('utf-8'))
+        )
+        cursor = conn.cursor()
+        _save_auth_record(cursor, *record)
+        cursor.close()
+        conn.execute("UPDATE auth SET key_id = ?, index_key = ?",
+                     (old_id + 1, Fernet(new_key).encrypt(index_key).decode('utf-8')))
+
+    print(f"🔁 Master key rotated (key {old_id} -> {old_id + 1}).")
+    return new_key
+
 def is_master_password_set() -> bool:
     """
     Check if a master password is already set by querying the auth table.
     Returns True if a master password exists, False otherwise.
     """
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         return False
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM auth")
     count = cursor.fetchone()[0]
     cursor.close()
-    conn.close()
     return count > 0
 
+
+def lock_vault():
+    """
+    Forget all key material cached for the unlocked session,
+    and the in-memory search index.
+    """
+    stop_search_index()
+    clear_session_caches()
+    print("🔒 Vault locked.")
@@ -156,6 +156,41 @@ def show_settings_dialog(on_save, current_theme: str, auto_delete: bool, max_rea
     return tag
 
 
+def show_rotate_key_dialog(on_confirm):
+    tag, w, h = "RotateKey", 500, 250
+    if dpg.does_item_exist(tag):
+        dpg.delete_item(tag)
+
+    def _confirm():
+        password = dpg.get_value("rotate_master_key") or ""
+        if not password.strip():
+            show_error_dialog("You must enter a Master Key to continue.")
+            return
+        dpg.delete_item(tag)
+        on_confirm(password)
+
+    with dpg.window(label="Rotate Master Key", tag=tag, modal=True, no_title_bar=True,
+                    no_resize=True, width=w, height=h, pos=[0,0]):
+        dpg.add_text("Rotate Master Key", bullet=True)
+        dpg.add_separator()
+        dpg.add_spacer(height=10)
+        dpg.add_text("A new encryption key is generated and each note's own", color=[200,200,200])
+        dpg.add_text("key is re-wrapped with it in the background.", color=[200,200,200])
+        dpg.add_spacer(height=10)
+        dpg.add_text("Confirm your Master Key:")
+        dpg.add_input_text(tag="rotate_master_key", password=True, width=w-100)
+        dpg.add_spacer(height=20)
+
+        with dpg.group(horizontal=True):
+            dpg.add_button(label="Rotate", width=100, callback=_confirm)
+            dpg.add_button(label="Cancel", width=100,
+                           callback=lambda: dpg.delete_item(tag))
+
+    center_window(tag, w, h, offset_x=100, offset_y=50)
+    dpg.show_item(tag)
+    return tag
+
+
 def show_error_dialog(message: str = "An error has occurred.."):
     tag, w, h = "ErrorDialog", 400, 150
     if dpg.does_item_exist(tag):
@@ -173,3 +208,41 @@ def show_error_dialog(message: str = "An error has occurred.."):
     dpg.show_item(tag)
     return tag
 
+
+
+def show_busy_dialog(message: str = "Working...", show_progress: bool = False):
+    """
+    Modal spinner shown while a background task runs. The render loop keeps
+    drawing, so the spinner animates at full frame rate.
+    With show_progress=True a progress bar is added; drive it with update_busy_dialog.
+    """
+    tag, w, h = "BusyDialog", 400, 150 if show_progress else 120
+    if dpg.does_item_exist(tag):
+        dpg.delete_item(tag)
+
+    with dpg.window(label="Please wait", tag=tag, modal=True,
+                    no_title_bar=True, no_resize=True, no_close=True,
+                    width=w, height=h):
+        with dpg.group(horizontal=True):
+            dpg.add_loading_indicator(style=1, radius=2.0)
+            dpg.add_text(message, tag="busy_message", wrap=300)
+        if show_progress:
+            dpg.add_spacer(height=10)
+            dpg.add_progress_bar(tag="busy_progress", default_value=0.0, width=-1)
+
+    center_window(tag, w, h, offset_x=150, offset_y=60)
+    dpg.show_item(tag)
+    return tag
+
+
+def update_busy_dialog(message: str = None, fraction: float = None):
+    if message is not None and dpg.does_item_exist("busy_message"):
+        dpg.set_value("busy_message", message)
+    if fraction is not None and dpg.does_item_exist("busy_progress"):
+        dpg.set_value("busy_progress", fraction)
+        dpg.configure_item("busy_progress", overlay=f"{fraction:.0%}")
+
+
+def hide_busy_dialog():
+    if dpg.does_item_exist("BusyDialog"):
+        dpg.delete_item("BusyDialog")
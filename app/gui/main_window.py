@@ -3,15 +3,24 @@
 import dearpygui.dearpygui as dpg
 import json
 import os
+import time
+import config
 
 from .styles import init_themes, apply_dark_theme, apply_light_theme
 from .dialogs import (
     show_splash,
     show_new_note_dialog,
     show_settings_dialog,
-    show_error_dialog
+    show_rotate_key_dialog,
+    show_error_dialog,
+    show_busy_dialog,
+    update_busy_dialog,
+    hide_busy_dialog
 )
-from .crypto_utils import encrypt_note, decrypt_note, generate_key_from_password
+from .tasks import TaskRunner
+from database import database
+from app import auth, notes, search, rotation
+from app.migration import migrate_json_notes, legacy_password_matches
 
 DATA_FILE = "notes_data.json"
 SETTINGS_FILE = "settings.json"
@@ -43,33 +52,61 @@ def run_app():
     
     app_state = {
         "username": None,
-        "master_key": None,   
-        "notes": [],     
+        "master_key": None,   # vault master key (bytes) once unlocked
+        "revision": None,     # change-feed revision the note list is up to date with
+        "rotating": False,    # a master-key rotation task has not handed back the new key yet
+        "listing": None,      # token of the note-list load whose pages are still arriving
+        "notes": {},          # note id -> list_notes item shown in the note list
         "auto_delete_enabled": settings["auto_delete_enabled"],
         "max_reads": settings["max_reads"]
     }
 
-    
-    def save_notes():
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(app_state["notes"], f, ensure_ascii=False, indent=2)
-
-
-    def load_notes():
-        if not os.path.exists(DATA_FILE):
-            app_state["notes"] = []
-            return
-
-        try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                contents = f.read().strip()
-                if contents:
-                    app_state["notes"] = json.loads(contents)
-                else:
-                    app_state["notes"] = []
-        except (json.JSONDecodeError, IOError):
-            app_state["notes"] = []
-
+    # KDF, database and crypto work runs here; results come back in the render loop
+    tasks = TaskRunner()
+
+    def on_task_error(e):
+        hide_busy_dialog()
+        show_error_dialog(str(e))
+
+    def unlock_vault(password):
+        """
+        Open (or create) the SQLite vault with the master password and import
+        a legacy notes_data.json on first unlock. Returns the master key or None.
+        """
+        database.initialize_database()
+        if auth.is_master_password_set():
+            master_key = auth.verify_master_password(password)
+            if master_key is None:
+                return None
+        else:
+            legacy_file = os.path.exists(DATA_FILE) or os.path.exists(DATA_FILE + ".journal")
+            # The legacy notes' password becomes the vault's: don't create it from a typo
+            if legacy_file and not legacy_password_matches(DATA_FILE, password):
+                return None
+            master_key = auth.setup_master_password(password)
+
+        if os.path.exists(DATA_FILE) or os.path.exists(DATA_FILE + ".journal"):
+            tasks.post(show_busy_dialog, "Importing notes...", True)
+            migrate_json_notes(
+                DATA_FILE, password, master_key,
+                progress=lambda count, fraction: tasks.post(
+                    update_busy_dialog, f"Importing notes: {count}", fraction)
+            )
+        notes.upgrade_ciphertext_format()
+        # Notes stored before titles had a blind index can't be found by title until indexed
+        notes.backfill_title_index(master_key)
+        notes.start_expiry_sweeper(master_key=master_key)
+        search.start_search_index(master_key)
+        # Resume a key rotation interrupted by a crash or exit
+        rotation.start_key_rotation(master_key)
+        return master_key
+
+    def close_vault():
+        rotation.stop_key_rotation()
+        notes.stop_expiry_sweeper()
+        auth.lock_vault()
+        app_state["master_key"] = None
+        database.close_all_connections()
 
     def save_settings():
         with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
@@ -79,80 +116,149 @@ def run_app():
                 "max_reads": app_state["max_reads"]
             }, f, ensure_ascii=False, indent=2)
 
+    def show_note_list():
+        if not dpg.does_item_exist("note_list"):
+            return
+        # While a query is typed the list shows search results instead
+        if dpg.does_item_exist("note_search") and dpg.get_value("note_search").strip():
+            return
+        items = sorted(app_state["notes"].values(),
+                       key=lambda note: (note["created_at"] or "", note["id"]), reverse=True)
+        dpg.configure_item("note_list", items=[note["title"] for note in items])
+
+    def apply_changes(changes):
+        if changes["reset"]:
+            app_state["revision"] = None
+            update_note_list()
+            return
+        for note_id in changes["deleted"]:
+            app_state["notes"].pop(note_id, None)
+        for note in changes["changed"]:
+            app_state["notes"][note["id"]] = note
+        app_state["revision"] = max(app_state["revision"] or 0, changes["revision"])
+        if changes["changed"] or changes["deleted"]:
+            show_note_list()
+
     def update_note_list():
+        """
+        Bring the note list up to date. The first call loads the notes page by
+        page (config.NOTE_LIST_PAGE_SIZE), showing each page as it arrives; later
+        ones fetch only the notes added, changed or removed since, whether by
+        this window, the expiry sweeper or another process on the same vault.
+        """
         if not dpg.does_item_exist("note_list"):
             return
         if not app_state["master_key"]:
             return
+        # Until the rotate task's callback runs, app_state still holds the old key
+        if app_state["rotating"]:
+            return
+
+        if app_state["revision"] is not None:
+            # Titles of changed notes are decrypted on the worker thread
+            tasks.submit(notes.changes_since, app_state["revision"], app_state["master_key"],
+                         on_done=apply_changes, on_error=on_task_error)
+            return
+
+        page_size = config.NOTE_LIST_PAGE_SIZE
+        # A reload (or lock) started meanwhile makes the remaining pages moot
+        listing = app_state["listing"] = object()
+
+        def load(key):
+            # Read the revision first: changes made during the listing come again as deltas
+            revision = notes.current_revision()
+            return revision, notes.list_notes(key, page_size=page_size)
+
+        def load_page(key, cursor):
+            return notes.list_notes(key, page_size=page_size, cursor=cursor)
+
+        def page_loaded(items):
+            if app_state["listing"] is not listing or not app_state["master_key"]:
+                return
+            # Pages are read after every delta applied so far, so they hold the newest copy
+            for note in items:
+                app_state["notes"][note["id"]] = note
+            show_note_list()
+            cursor = notes.next_page_cursor(items, page_size)
+            if cursor is not None:
+                tasks.submit(load_page, app_state["master_key"], cursor,
+                             on_done=page_loaded, on_error=on_task_error)
+
+        def loaded(result):
+            revision, items = result
+            if app_state["listing"] is not listing:
+                return
+            app_state["revision"] = revision
+            app_state["notes"] = {}
+            page_loaded(items)
+
+        tasks.submit(load, app_state["master_key"], on_done=loaded, on_error=on_task_error)
+
+    def on_search(_, query):
+        if not query.strip():
+            show_note_list()
+            return
+
+        def show_results(results):
+            if dpg.does_item_exist("note_list"):
+                dpg.configure_item("note_list", items=[result["title"] for result in results])
 
-        items = []
-        key = generate_key_from_password(app_state["master_key"])
-        for note in app_state["notes"]:
-            try:
-                items.append(decrypt_note(note["title"], key))
-            except:
-                items.append("<errore>")
-        dpg.configure_item("note_list", items=items)
+        tasks.submit(search.search_notes, query, master_key=app_state["master_key"],
+                     on_done=show_results, on_error=on_task_error)
 
     def on_note_selected(_, title):
         if not title:
             return
 
-        key = generate_key_from_password(app_state["master_key"])
-        for note in app_state["notes"]:
-            try:
-                if decrypt_note(note["title"], key) == title:
-                    break
-            except:
-                continue
-        else:
-            dpg.set_value("note_display", "Error: note not found.")
-            return
+        def open_note(key, count_open):
+            note_id = notes.find_note_by_title(title, key)
+            if note_id is None:
+                return None
+            return notes.read_note(note_id, key, count_open=count_open)
 
-        limit = note.get("max_reads", app_state["max_reads"])
-        if app_state["auto_delete_enabled"]:
-            note["read_count"] = note.get("read_count", 0) + 1
-            if note["read_count"] > limit:
-                app_state["notes"].remove(note)
-                save_notes()
+        def show_note(note):
+            if note is None:
+                dpg.set_value("note_display", "Error: note not found.")
+                return
+            if note["deleted"]:
                 update_note_list()
-                dpg.set_value("note_display", f"Note deleted after {limit} reads.")
+                dpg.set_value("note_display", "Note deleted after reaching its read limit.")
                 return
 
-        try:
-            body = decrypt_note(note["content_encrypted"], key)
-        except:
-            body = "<error decrypting content>"
-        dpg.set_value("note_display", f"Title: {title}\n\n{body}")
-        save_notes()
+            text = f"Title: {title}\n\n{note['content']}"
+            if note["max_opens"] is not None and note["open_count"] >= note["max_opens"]:
+                update_note_list()
+                text += f"\n\n(This was read {note['max_opens']} of {note['max_opens']} times and has been deleted.)"
+            dpg.set_value("note_display", text)
+
+        dpg.set_value("note_display", "Opening note...")
+        tasks.submit(open_note, app_state["master_key"], app_state["auto_delete_enabled"],
+                     on_done=show_note, on_error=on_task_error)
 
     def on_note_created(title, content, per_note_reads):
         if not app_state["master_key"]:
             show_error_dialog("You must enter a Master Key to continue.")
             return
 
-        key = generate_key_from_password(app_state["master_key"])
-
-        for note in app_state["notes"]:
-            try:
-                if decrypt_note(note["title"], key) == title:
-                    show_error_dialog("Title already exists.")
-                    return
-            except:
-                continue
-
-        enc_t = encrypt_note(title, key)
-        enc_c = encrypt_note(content, key)
-        app_state["notes"].append({
-            "title": enc_t,
-            "content_encrypted": enc_c,
-            "read_count": 0,
-            "max_reads": per_note_reads or app_state["max_reads"]
-        })
-        save_notes()
-        if dpg.does_item_exist("NewNote"):
-            dpg.delete_item("NewNote")
-        update_note_list()
+        def create(key, max_opens):
+            if notes.title_exists(title, key):
+                return False
+            # Failures raise and reach on_task_error; the dialog stays open
+            notes.create_note(title, content, key, max_opens=max_opens)
+            return True
+
+        def created(ok):
+            hide_busy_dialog()
+            if not ok:
+                show_error_dialog("Title already exists.")
+                return
+            if dpg.does_item_exist("NewNote"):
+                dpg.delete_item("NewNote")
+            update_note_list()
+
+        show_busy_dialog("Encrypting note...")
+        tasks.submit(create, app_state["master_key"], per_note_reads or app_state["max_reads"],
+                     on_done=created, on_error=on_task_error)
 
     def delete_note():
         title = dpg.get_value("note_list") or ""
@@ -160,19 +266,47 @@ def run_app():
             show_error_dialog("Select a note to delete.")
             return
 
-        key = generate_key_from_password(app_state["master_key"])
-        for note in app_state["notes"]:
-            try:
-                if decrypt_note(note["title"], key) == title:
-                    app_state["notes"].remove(note)
-                    save_notes()
-                    update_note_list()
-                    dpg.set_value("note_display", "Note deleted.")
-                    return
-            except:
-                continue
+        def delete(key):
+            note_id = notes.find_note_by_title(title, key)
+            if note_id is None:
+                return False
+            return notes.delete_note(note_id, key)
 
-        show_error_dialog("Note not found.")
+        def deleted(ok):
+            if not ok:
+                show_error_dialog("Note not found.")
+                return
+            update_note_list()
+            dpg.set_value("note_display", "Note deleted.")
+
+        tasks.submit(delete, app_state["master_key"], on_done=deleted, on_error=on_task_error)
+
+    def on_rotate_key(password):
+        def rotate():
+            rotation.stop_key_rotation()
+            master_key = auth.rotate_master_key(password)
+            if master_key is not None:
+                rotation.start_key_rotation(master_key)
+                # The sweeper unindexes purged notes with the master key: hand it the new one
+                notes.stop_expiry_sweeper()
+                notes.start_expiry_sweeper(master_key=master_key)
+            return master_key
+
+        def rotated(master_key):
+            app_state["rotating"] = False
+            hide_busy_dialog()
+            if master_key is None:
+                show_error_dialog("Wrong Master Key.")
+                return
+            app_state["master_key"] = master_key
+
+        def rotate_failed(e):
+            app_state["rotating"] = False
+            on_task_error(e)
+
+        app_state["rotating"] = True
+        show_busy_dialog("Rotating master key...")
+        tasks.submit(rotate, on_done=rotated, on_error=rotate_failed)
 
     def on_settings_saved(theme, auto_del, max_reads, _):
         settings["theme"] = theme
@@ -186,7 +320,6 @@ def run_app():
         save_settings()
 
     def create_main_window(user):
-        load_notes()
         if dpg.does_item_exist("Main Window"):
             dpg.delete_item("Main Window")
 
@@ -209,9 +342,13 @@ def run_app():
                             app_state["max_reads"]
                         )
                     )
+                    dpg.add_menu_item(
+                        label="Rotate Master Key",
+                        callback=lambda: show_rotate_key_dialog(on_rotate_key)
+                    )
                     dpg.add_menu_item(
                         label="Exit",
-                        callback=lambda: (save_notes(), dpg.stop_dearpygui())
+                        callback=lambda: dpg.stop_dearpygui()
                     )
 
             dpg.add_text(f"Welcome, {user}!", color=[200, 200, 100])
@@ -220,6 +357,12 @@ def run_app():
             with dpg.group(horizontal=True):
                 with dpg.child_window(tag="Sidebar", width=250, height=-1):
                     dpg.add_text("Your Notes:")
+                    dpg.add_input_text(
+                        tag="note_search",
+                        hint="Search notes...",
+                        width=230,
+                        callback=on_search
+                    )
                     dpg.add_listbox(
                         tag="note_list",
                         items=[],
@@ -246,14 +389,37 @@ def run_app():
         update_note_list()
 
     def on_splash_done(user, mk):
-        app_state["username"] = user
-        app_state["master_key"] = mk
-        dpg.delete_item("Splash")
-        create_main_window(user)
+        if tasks.busy:
+            return
+
+        def unlocked(master_key):
+            hide_busy_dialog()
+            if master_key is None:
+                show_error_dialog("Wrong Master Key.")
+                return
+
+            app_state["username"] = user
+            app_state["master_key"] = master_key
+            dpg.delete_item("Splash")
+            create_main_window(user)
+
+        # The KDF takes a noticeable fraction of a second by design: keep it off the render thread
+        show_busy_dialog("Unlocking vault...")
+        tasks.submit(unlock_vault, mk, on_done=unlocked, on_error=on_task_error)
 
     show_splash(on_splash_done)
     dpg.show_viewport()
-    dpg.start_dearpygui()
+    poll_interval = config.CHANGE_POLL_INTERVAL_MS / 1000.0
+    next_poll = time.monotonic() + poll_interval
+    while dpg.is_dearpygui_running():
+        tasks.drain()
+        # Pick up changes made outside this window (other processes, the sweeper)
+        if app_state["revision"] is not None and not tasks.busy and time.monotonic() >= next_poll:
+            next_poll = time.monotonic() + poll_interval
+            update_note_list()
+        dpg.render_dearpygui_frame()
+    tasks.shutdown()
+    close_vault()
     dpg.destroy_context()
 
 
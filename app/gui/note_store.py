@@ -0,0 +1,104 @@
+# app/gui/note_store.py
+
+import json
+import os
+
+# Compact once the journal holds this many entries (or more than the notes themselves)
+COMPACT_THRESHOLD = 200
+
+
+class JournaledNoteStore:
+    """
+    Crash-safe storage for the GUI's notes.
+
+    The snapshot file keeps the original notes_data.json format (a JSON list).
+    Every change is appended to `<snapshot>.journal` as one JSON line and fsynced,
+    so a read-count bump writes one short line instead of the whole vault.
+    The journal is folded into a new snapshot (written to a temp file and
+    atomically renamed) once it grows past COMPACT_THRESHOLD.
+    Notes are identified by their "title_index".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self._journal_entries = 0
+
+    def load(self) -> list:
+        """Read the snapshot and replay the journal on top of it."""
+        notes = self._read_snapshot()
+        by_key = {note.get("title_index"): note for note in notes if note.get("title_index")}
+
+        self._journal_entries = 0
+        torn = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line from a crash mid-append: everything before it is intact
+                        torn = True
+                        break
+                    self._apply(entry, notes, by_key)
+                    self._journal_entries += 1
+        if torn:
+            # Don't append after garbage: start over from a clean snapshot
+            self.compact(notes)
+        return notes
+
+    def put(self, note: dict, notes: list):
+        """Record that `note` was added or changed."""
+        self._append({"op": "put", "note": note}, notes)
+
+    def delete(self, note: dict, notes: list):
+        """Record that `note` was removed."""
+        self._append({"op": "delete", "title_index": note.get("title_index")}, notes)
+
+    def compact(self, notes: list):
+        """Write a fresh snapshot atomically and empty the journal."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(notes, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_entries = 0
+
+    def _append(self, entry: dict, notes: list):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_entries += 1
+        if self._journal_entries >= max(COMPACT_THRESHOLD, len(notes)):
+            self.compact(notes)
+
+    def _read_snapshot(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                contents = f.read().strip()
+                return json.loads(contents) if contents else []
+        except (json.JSONDecodeError, IOError):
+            return []
+
+    @staticmethod
+    def _apply(entry: dict, notes: list, by_key: dict):
+        if entry.get("op") == "put":
+            note = entry["note"]
+            key = note.get("title_index")
+            existing = by_key.get(key)
+            if existing is not None:
+                existing.clear()
+                existing.update(note)
+            else:
+                notes.append(note)
+                by_key[key] = note
+        elif entry.get("op") == "delete":
+            existing = by_key.pop(entry.get("title_index"), None)
+            if existing is not None:
+                notes.remove(existing)
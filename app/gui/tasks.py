@@ -0,0 +1,89 @@
+# app/gui/tasks.py
+
+import queue
+import threading
+
+
+class TaskRunner:
+    """
+    Runs slow work (KDF, database, crypto) off the render thread.
+
+    Tasks run one at a time, in submission order, on a single worker thread, so
+    they see each other's writes and share that thread's database connection.
+    Their results are put on a queue that the render loop empties with drain()
+    every frame; the on_done / on_error callbacks therefore run on the render
+    thread, where it is safe to touch Dear PyGui items.
+    """
+
+    def __init__(self, name: str = "gui-worker"):
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, on_done=None, on_error=None, **kwargs):
+        """
+        Queue func(*args, **kwargs) for the worker thread.
+        on_done(result) or on_error(exception) is called from drain() once it finishes.
+        """
+        with self._lock:
+            self._pending += 1
+        self._tasks.put((func, args, kwargs, on_done, on_error))
+
+    def post(self, callback, *args):
+        """
+        Schedule callback(*args) on the render thread (e.g. a progress update
+        from inside a running task).
+        """
+        self._results.put((callback, args))
+
+    def drain(self, max_items: int = 50):
+        """
+        Run the callbacks of finished tasks. Call once per frame from the render loop.
+        At most max_items callbacks run per call so a burst of results can't stall a frame.
+        """
+        for _ in range(max_items):
+            try:
+                callback, args = self._results.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"⚠️ UI callback failed: {e}")
+
+    @property
+    def busy(self) -> bool:
+        """True while a submitted task has not finished yet."""
+        with self._lock:
+            return self._pending > 0
+
+    def shutdown(self):
+        """
+        Let the queued tasks finish, then stop the worker thread.
+        Callbacks still waiting in the result queue are dropped.
+        """
+        self._tasks.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, args, kwargs, on_done, on_error = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if on_error is not None:
+                    self._results.put((on_error, (e,)))
+                else:
+                    print(f"⚠️ Background task failed: {e}")
+            else:
+                if on_done is not None:
+                    self._results.put((on_done, (result,)))
+            finally:
+                with self._lock:
+                    self._pending -= 1
@@ -1,61 +1,816 @@
+import io
 import os
+import hmac
+import lzma
+import zlib
+import base64
+import hashlib
+import threading
+import config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from cryptography.fernet import Fernet
+from functools import lru_cache
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap, InvalidUnwrap
 from database import database  
 
+# Number of distinct keys whose cipher objects are kept alive at once
+CIPHER_CACHE_SIZE = 8
+
+# Binary ciphertext envelope: one format byte followed by the payload.
+# 0x01 = the raw (un-base64'd) bytes of a Fernet token.
+# 0x02 = AES-256-GCM: 12-byte nonce + ciphertext + tag.
+# 0x03 = ChaCha20-Poly1305: 12-byte nonce + ciphertext + tag.
+# For the AEAD formats, bits 0x30 of the format byte flag a compression stage
+# applied before encryption: 0x10 = zlib, 0x20 = lzma.
+# 0x04 = chunked AEAD stream for large values (see StreamCipher).
+# Legacy values are base64 Fernet tokens, which always start with b"g".
+ENVELOPE_FERNET = b"\x01"
+ENVELOPE_AES_GCM = b"\x02"
+ENVELOPE_CHACHA20 = b"\x03"
+ENVELOPE_STREAM = b"\x04"
+LEGACY_TOKEN_PREFIX = b"g"
+ENGINE_MASK = 0x0F
+COMPRESSION_MASK = 0x30
+COMPRESSION_ZLIB = 0x10
+COMPRESSION_LZMA = 0x20
+_STREAM_NONCE_PREFIX_SIZE = 7
+_STREAM_HEADER_SIZE = 1 + 1 + 4 + _STREAM_NONCE_PREFIX_SIZE  # format, engine, segment size, nonce prefix
+_STREAM_TAG_SIZE = 16
+
 def generate_key() -> bytes:
     """
     Generate a new Fernet key.
     """
     return Fernet.generate_key()
 
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
 def get_fernet(key: bytes) -> Fernet:
     """
     Return a Fernet instance for the given key.
+    Instances are cached per key, so an unlocked session builds its cipher once.
     """
     return Fernet(key)
 
+class FernetEngine:
+    """
+    Envelope 0x01: a Fernet token (AES-128-CBC + HMAC-SHA256) stored as raw bytes
+    instead of base64. The cryptography package does the crypto; only the
+    base64 wrapping is undone here. Never carries compression flags.
+    """
+    supports_compression = False
+
+    def __init__(self, key: bytes):
+        self._fernet = get_fernet(key)
+
+    def encrypt(self, data: bytes) -> bytes:
+        return ENVELOPE_FERNET + base64.urlsafe_b64decode(self._fernet.encrypt(data))
+
+    def decrypt(self, envelope: bytes) -> bytes:
+        return self._fernet.decrypt(base64.urlsafe_b64encode(envelope[1:]))
+
+class AeadEngine:
+    """
+    Single-pass AEAD envelope: format byte + 12-byte nonce + ciphertext + tag.
+    The format byte (including its compression flags) is bound as associated data.
+    The AEAD key is an HKDF subkey of the master key, so it is never used
+    directly by two algorithms.
+    """
+    NONCE_SIZE = 12
+    supports_compression = True
+
+    def __init__(self, key: bytes, marker: bytes, aead_class, label: bytes):
+        self._marker = marker
+        subkey = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                      info=b"securenotes/aead/" + label).derive(key)
+        self._aead = aead_class(subkey)
+
+    def encrypt(self, data: bytes, flags: int = 0) -> bytes:
+        header = bytes([self._marker[0] | flags])
+        nonce = os.urandom(self.NONCE_SIZE)
+        return header + nonce + self._aead.encrypt(nonce, data, header)
+
+    def decrypt(self, envelope: bytes) -> bytes:
+        header = envelope[:1]
+        nonce = envelope[1:1 + self.NONCE_SIZE]
+        try:
+            return self._aead.decrypt(nonce, envelope[1 + self.NONCE_SIZE:], header)
+        except InvalidTag:
+            raise InvalidToken
+
+# Envelope format byte -> (config name, engine factory)
+CIPHER_REGISTRY = {
+    ENVELOPE_FERNET: ("fernet", lambda key: FernetEngine(key)),
+    ENVELOPE_AES_GCM: ("aes-gcm", lambda key: AeadEngine(key, ENVELOPE_AES_GCM, AESGCM, b"aes-256-gcm")),
+    ENVELOPE_CHACHA20: ("chacha20", lambda key: AeadEngine(key, ENVELOPE_CHACHA20, ChaCha20Poly1305, b"chacha20-poly1305")),
+}
+
+def cipher_marker(name: str) -> bytes:
+    """
+    Return the envelope format byte for a cipher name from config.CIPHER_ENGINE.
+    """
+    for marker, (engine_name, _) in CIPHER_REGISTRY.items():
+        if engine_name == name:
+            return marker
+    raise ValueError(f"Unknown cipher engine: {name}")
+
+class EnvelopeCipher:
+    """
+    Encrypts with the configured engine and decrypts any registered envelope
+    format (dispatching on the format byte) as well as legacy base64 Fernet tokens.
+    Engines are built lazily, once per key.
+    """
+
+    def __init__(self, key: bytes, engine: str = None):
+        self._key = key
+        self._engines = {}
+        self._stream = None
+        self.marker = cipher_marker(engine or config.CIPHER_ENGINE)
+
+    def _engine(self, marker: bytes):
+        engine = self._engines.get(marker)
+        if engine is None:
+            if marker not in CIPHER_REGISTRY:
+                raise InvalidToken
+            engine = self._engines[marker] = CIPHER_REGISTRY[marker][1](self._key)
+        return engine
+
+    def encrypt(self, data: bytes) -> bytes:
+        engine = self._engine(self.marker)
+        if not engine.supports_compression:
+            return engine.encrypt(data)
+        data, flags = compress_payload(data)
+        return engine.encrypt(data, flags)
+
+    def decrypt(self, envelope) -> bytes:
+        if isinstance(envelope, str):
+            envelope = envelope.encode("ascii")
+        if envelope[:1] == LEGACY_TOKEN_PREFIX:
+            return get_fernet(self._key).decrypt(envelope)
+        if envelope[:1] == ENVELOPE_STREAM:
+            plaintext = io.BytesIO()
+            self.stream().decrypt(io.BytesIO(envelope), plaintext)
+            return plaintext.getvalue()
+        header = envelope[0]
+        plaintext = self._engine(bytes([header & ENGINE_MASK])).decrypt(envelope)
+        return decompress_payload(plaintext, header & COMPRESSION_MASK)
+
+    def stream(self):
+        """
+        Return the chunked cipher for large values, built once per key.
+        It uses the configured engine, or AES-GCM when that is Fernet.
+        """
+        if self._stream is None:
+            self._stream = StreamCipher(self._key, self.marker)
+        return self._stream
+
+    def is_current(self, envelope) -> bool:
+        """
+        True if the value is already encrypted with the configured engine.
+        """
+        if isinstance(envelope, str) or envelope[:1] == LEGACY_TOKEN_PREFIX:
+            return False
+        return envelope[0] & ENGINE_MASK == self.marker[0]
+
+def compress_payload(data: bytes):
+    """
+    Compress a plaintext before encryption when it is large enough to benefit.
+    Below config.COMPRESSION_MIN_SIZE nothing is done; from config.LZMA_MIN_SIZE
+    on lzma is used, zlib in between. The result is kept only if it is smaller.
+    Returns (payload, compression_flag).
+    """
+    if not config.COMPRESSION_ENABLED or len(data) < config.COMPRESSION_MIN_SIZE:
+        return data, 0
+    if len(data) >= config.LZMA_MIN_SIZE:
+        compressed, flag = lzma.compress(data, preset=6), COMPRESSION_LZMA
+    else:
+        compressed, flag = zlib.compress(data, 6), COMPRESSION_ZLIB
+    if len(compressed) >= len(data):
+        return data, 0
+    return compressed, flag
+
+def decompress_payload(payload: bytes, flag: int) -> bytes:
+    """
+    Undo compress_payload given the compression flag from the envelope header.
+    """
+    if flag == 0:
+        return payload
+    if flag == COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    if flag == COMPRESSION_LZMA:
+        return lzma.decompress(payload, format=lzma.FORMAT_XZ)
+    raise InvalidToken
+
+# Envelope format byte -> (AEAD class, HKDF label) usable inside a stream
+STREAM_AEADS = {
+    ENVELOPE_AES_GCM: (AESGCM, b"stream/aes-256-gcm"),
+    ENVELOPE_CHACHA20: (ChaCha20Poly1305, b"stream/chacha20-poly1305"),
+}
+
+class StreamCipher:
+    """
+    Envelope 0x04: chunked AEAD that encrypts and decrypts one segment at a time,
+    so memory use does not depend on the size of the value.
+
+    Header: format byte, inner engine byte (0x02/0x03), segment size (4 bytes),
+    random 7-byte nonce prefix. Every segment holds up to segment-size bytes of
+    plaintext plus a 16-byte tag. Its nonce is the prefix + a 4-byte segment counter
+    + a 1-byte final flag, and the header is its associated data, so segments
+    cannot be reordered, dropped, truncated or moved to another value.
+    """
+
+    def __init__(self, key: bytes, marker: bytes):
+        self._key = key
+        self._marker = marker if marker in STREAM_AEADS else ENVELOPE_AES_GCM
+        self._aeads = {}
+
+    def _aead(self, marker: bytes):
+        aead = self._aeads.get(marker)
+        if aead is None:
+            if marker not in STREAM_AEADS:
+                raise InvalidToken
+            aead_class, label = STREAM_AEADS[marker]
+            subkey = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                          info=b"securenotes/aead/" + label).derive(self._key)
+            aead = self._aeads[marker] = aead_class(subkey)
+        return aead
+
+    @staticmethod
+    def _nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+        return prefix + counter.to_bytes(4, "big") + (b"\x01" if final else b"\x00")
+
+    def _parse_header(self, header: bytes):
+        """Return (aead, segment_size, nonce_prefix) for an envelope header."""
+        if len(header) != _STREAM_HEADER_SIZE or header[:1] != ENVELOPE_STREAM:
+            raise InvalidToken
+        segment_size = int.from_bytes(header[2:6], "big")
+        if segment_size <= 0:
+            raise InvalidToken
+        return self._aead(header[1:2]), segment_size, header[6:]
+
+    @staticmethod
+    def ciphertext_size(plaintext_size: int, segment_size: int = None) -> int:
+        """
+        Exact envelope size for a plaintext of plaintext_size bytes, so the
+        destination blob can be allocated before streaming into it.
+        """
+        segment_size = segment_size or config.STREAM_SEGMENT_SIZE
+        segments = max(1, -(-plaintext_size // segment_size))
+        return _STREAM_HEADER_SIZE + plaintext_size + segments * _STREAM_TAG_SIZE
+
+    def encrypt(self, source, sink, segment_size: int = None) -> int:
+        """
+        Read plaintext from source.read(n) and write the envelope with sink.write(b).
+        Returns the number of plaintext bytes encrypted.
+        """
+        segment_size = segment_size or config.STREAM_SEGMENT_SIZE
+        prefix = os.urandom(_STREAM_NONCE_PREFIX_SIZE)
+        header = ENVELOPE_STREAM + self._marker + segment_size.to_bytes(4, "big") + prefix
+        aead = self._aead(self._marker)
+        sink.write(header)
+
+        total = 0
+        counter = 0
+        segment = source.read(segment_size)
+        while True:
+            # Read one segment ahead to know whether this one is the last
+            following = source.read(segment_size) if len(segment) == segment_size else b""
+            final = not following
+            sink.write(aead.encrypt(self._nonce(prefix, counter, final), segment, header))
+            total += len(segment)
+            if final:
+                return total
+            segment = following
+            counter += 1
+
+    def decrypt(self, source, sink) -> int:
+        """
+        Read an envelope from source.read(n) and write the plaintext with sink.write(b),
+        one verified segment at a time. Raises InvalidToken on any tampering or truncation.
+        Returns the number of plaintext bytes written.
+        """
+        header = source.read(_STREAM_HEADER_SIZE)
+        aead, segment_size, prefix = self._parse_header(header)
+        chunk_size = segment_size + _STREAM_TAG_SIZE
+
+        total = 0
+        counter = 0
+        chunk = source.read(chunk_size)
+        while True:
+            following = source.read(chunk_size) if len(chunk) == chunk_size else b""
+            final = not following
+            try:
+                segment = aead.decrypt(self._nonce(prefix, counter, final), chunk, header)
+            except InvalidTag:
+                raise InvalidToken
+            sink.write(segment)
+            total += len(segment)
+            if final:
+                return total
+            chunk = following
+            counter += 1
+
+    def reencrypt_in_place(self, blob, target: "StreamCipher"):
+        """
+        Re-encrypt the envelope held in a writable sqlite3.Blob under target's key,
+        one segment at a time and at the same offsets (every segment keeps its size).
+        Run it inside one transaction, so a crash leaves the old or the new
+        envelope, never a mix of both.
+        """
+        length = len(blob)
+        blob.seek(0)
+        header = blob.read(_STREAM_HEADER_SIZE)
+        aead, segment_size, prefix = self._parse_header(header)
+        new_prefix = os.urandom(_STREAM_NONCE_PREFIX_SIZE)
+        new_header = ENVELOPE_STREAM + target._marker + header[2:6] + new_prefix
+        new_aead = target._aead(target._marker)
+        chunk_size = segment_size + _STREAM_TAG_SIZE
+
+        offset = _STREAM_HEADER_SIZE
+        counter = 0
+        while True:
+            blob.seek(offset)
+            chunk = blob.read(chunk_size)
+            final = offset + len(chunk) >= length
+            try:
+                segment = aead.decrypt(self._nonce(prefix, counter, final), chunk, header)
+            except InvalidTag:
+                raise InvalidToken
+            blob.seek(offset)
+            blob.write(new_aead.encrypt(self._nonce(new_prefix, counter, final), segment, new_header))
+            if final:
+                break
+            offset += len(chunk)
+            counter += 1
+        blob.seek(0)
+        blob.write(new_header)
+
+def is_stream_envelope(ciphertext) -> bool:
+    """
+    True if a stored value uses the chunked stream format.
+    """
+    return ciphertext[:1] == ENVELOPE_STREAM
+
+def stream_ciphertext_size(plaintext_size: int, segment_size: int = None) -> int:
+    """
+    Size in bytes of the stream envelope for a plaintext of plaintext_size bytes.
+    """
+    return StreamCipher.ciphertext_size(plaintext_size, segment_size)
+
+def encrypt_stream(source, sink, key: bytes, segment_size: int = None) -> int:
+    """
+    Encrypt from a readable file-like object into a writable one (e.g. a sqlite3.Blob)
+    in fixed-size segments, holding at most two segments in memory.
+    """
+    return _as_cipher(key).stream().encrypt(source, sink, segment_size)
+
+def decrypt_stream(source, sink, key: bytes) -> int:
+    """
+    Decrypt a stream envelope from a readable file-like object into a writable one.
+    """
+    return _as_cipher(key).stream().decrypt(source, sink)
+
+def reencrypt_stream_in_place(blob, old_key: bytes, new_key: bytes):
+    """
+    Move a stream envelope stored in a writable blob from old_key to new_key
+    with constant memory (see StreamCipher.reencrypt_in_place).
+    """
+    _as_cipher(old_key).stream().reencrypt_in_place(blob, _as_cipher(new_key).stream())
+
+def to_envelope(ciphertext) -> bytes:
+    """
+    Convert a legacy base64 Fernet token to the binary envelope without any key.
+    Values that are already envelopes are returned unchanged.
+    """
+    if isinstance(ciphertext, str):
+        ciphertext = ciphertext.encode("ascii")
+    if ciphertext[:1] != LEGACY_TOKEN_PREFIX:
+        return ciphertext
+    return ENVELOPE_FERNET + base64.urlsafe_b64decode(ciphertext)
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def get_cipher(key: bytes) -> EnvelopeCipher:
+    """
+    Return the envelope cipher for the given key, cached like get_fernet.
+    """
+    return EnvelopeCipher(key)
+
+def _as_cipher(key) -> EnvelopeCipher:
+    """
+    Accept either a key (bytes) or a ready cipher, such as a note's data key cipher.
+    """
+    if isinstance(key, EnvelopeCipher):
+        return key
+    return get_cipher(key)
+
+def needs_reencryption(ciphertext, key: bytes) -> bool:
+    """
+    True if a stored ciphertext uses an older format than the configured engine.
+    """
+    return not _as_cipher(key).is_current(ciphertext)
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def _blind_index_key(key: bytes) -> bytes:
+    """
+    Derive the blind-index subkey from an encryption key, so the index never
+    reuses the key that protects the ciphertexts.
+    """
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b"securenotes/blind-index").derive(key)
+
+def title_blind_index(title: str, key: bytes) -> str:
+    """
+    Return the keyed blind index (HMAC-SHA256, hex) of a plaintext title.
+    Equal titles under the same key give equal indexes; without the key
+    the index reveals nothing about the title.
+    """
+    return hmac.new(_blind_index_key(key), title.encode("utf-8"), hashlib.sha256).hexdigest()
+
+class Keyring:
+    """
+    The current master key plus the older keys that rows may still be encrypted
+    under while a key rotation is in progress. Key IDs are the values of
+    notes.key_id / attachments.key_id; auth.key_id is the current one.
+    """
+
+    def __init__(self, current_id: int, keys: dict, index_key: bytes = None):
+        self.current_id = current_id
+        self._keys = keys
+        # Blind indexes and search tokens use this key, which survives rotations
+        self.index_key = index_key or keys[current_id]
+
+    @property
+    def current_key(self) -> bytes:
+        return self._keys[self.current_id]
+
+    @property
+    def rotating(self) -> bool:
+        """True while older keys are still around."""
+        return len(self._keys) > 1
+
+    def key(self, key_id: int) -> bytes:
+        """Return the key with this ID; raises InvalidToken if it is unknown."""
+        try:
+            return self._keys[key_id]
+        except KeyError:
+            raise InvalidToken
+
+    def keys(self) -> list:
+        return list(self._keys.values())
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def get_keyring(master_key: bytes) -> Keyring:
+    """
+    Load the keyring for the current master key. Each encryption_keys row holds
+    an older key wrapped (Fernet) under the key with the next ID, so the whole
+    chain unwraps from the current key; auth.index_key is wrapped under the
+    current key. Cached per key; call clear_keyring_cache after a rotation
+    changes the table.
+    """
+    current_id = 1
+    keys = {current_id: master_key}
+    index_key = None
+    conn = database.get_connection()
+    if conn is None:
+        return Keyring(current_id, keys)
+    row = conn.execute("SELECT key_id, index_key FROM auth LIMIT 1").fetchone()
+    if row is not None:
+        current_id = row[0]
+        keys = {current_id: master_key}
+        # Until the first rotation the index key is the master key itself
+        if row[1] is not None:
+            index_key = get_fernet(master_key).decrypt(row[1].encode("utf-8"))
+    rows = conn.execute(
+        "SELECT id, key_data FROM encryption_keys WHERE id < ? ORDER BY id DESC", (current_id,)
+    ).fetchall()
+    for key_id, key_data in rows:
+        wrapping_key = keys.get(key_id + 1)
+        if wrapping_key is None:
+            break
+        try:
+            keys[key_id] = get_fernet(wrapping_key).decrypt(key_data.encode("utf-8"))
+        except InvalidToken:
+            break
+    return Keyring(current_id, keys, index_key)
+
+def clear_keyring_cache():
+    get_keyring.cache_clear()
+
+def check_current_key(conn, key_id: int):
+    """
+    Raise RuntimeError if `key_id` is no longer the vault's current master key
+    ID, i.e. the key was rotated (possibly by another process) after the caller
+    unlocked. Call it inside the write transaction, after its first write, so
+    the write lock keeps auth from changing until the rows commit: a rotation
+    job then never deletes an old key that rows are still being written under.
+    """
+    row = conn.execute("SELECT key_id FROM auth LIMIT 1").fetchone()
+    if row is not None and row[0] != key_id:
+        raise RuntimeError("The master key was rotated in another session; unlock the vault again.")
+
+def get_index_key(master_key: bytes) -> bytes:
+    """
+    Return the key that title blind indexes and search tokens are derived from.
+    """
+    return get_keyring(master_key).index_key
+
+# Per-note data keys (DEKs): every note and attachment is encrypted under its
+# own random key, stored in the row wrapped (AES key wrap, RFC 3394) under a
+# subkey of the master key. A key rotation only rewraps these 40-byte values.
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def _key_wrapping_key(key: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b"securenotes/data-key-wrap").derive(key)
+
+def new_data_key(master_key: bytes):
+    """
+    Generate a data key for a new note or attachment.
+    Returns (cipher, wrapped_key, key_id): the cipher to encrypt the row with, and
+    the values to store in its wrapped_key and key_id columns.
+    """
+    keyring = get_keyring(master_key)
+    raw_key = os.urandom(32)
+    wrapped_key = aes_key_wrap(_key_wrapping_key(keyring.current_key), raw_key)
+    return EnvelopeCipher(base64.urlsafe_b64encode(raw_key)), wrapped_key, keyring.current_id
+
+@lru_cache(maxsize=config.DATA_KEY_CACHE_SIZE)
+def unwrap_data_key(wrapped_key: bytes, key: bytes) -> EnvelopeCipher:
+    """
+    Unwrap a data key and return its cipher. The session keeps the most recently
+    used config.DATA_KEY_CACHE_SIZE of them, so hot notes skip the unwrap and the
+    subkey derivation. Raises InvalidToken if the key does not unwrap.
+    """
+    try:
+        raw_key = aes_key_unwrap(_key_wrapping_key(key), wrapped_key)
+    except InvalidUnwrap:
+        raise InvalidToken
+    return EnvelopeCipher(base64.urlsafe_b64encode(raw_key))
+
+def rewrap_data_key(wrapped_key: bytes, old_key: bytes, new_key: bytes) -> bytes:
+    """
+    Move a wrapped data key from old_key to new_key; the data it protects is untouched.
+    """
+    try:
+        raw_key = aes_key_unwrap(_key_wrapping_key(old_key), wrapped_key)
+    except InvalidUnwrap:
+        raise InvalidToken
+    return aes_key_wrap(_key_wrapping_key(new_key), raw_key)
+
+def row_cipher(key_id: int, wrapped_key: bytes, master_key: bytes) -> EnvelopeCipher:
+    """
+    Return the cipher for a stored row: its data key if it has one, else (rows
+    written before data keys existed) the keyring key it was encrypted under.
+    Raises InvalidToken if the key is unknown or does not unwrap.
+    """
+    return _keyring_cipher(get_keyring(master_key), key_id, wrapped_key)
+
+def _keyring_cipher(keyring: Keyring, key_id: int, wrapped_key: bytes) -> EnvelopeCipher:
+    # No database access, so it can run on the crypto thread pool
+    key = keyring.key(key_id)
+    if wrapped_key is None:
+        return get_cipher(key)
+    return unwrap_data_key(wrapped_key, key)
+
+def decrypt_strings_keyed(encrypted_items, key_ids, master_key: bytes, default: str = None,
+                          wrapped_keys=None) -> list:
+    """
+    Like decrypt_strings for rows that each have their own key: key_ids and
+    wrapped_keys hold every item's notes.key_id / notes.wrapped_key (see row_cipher).
+    Items whose key cannot be recovered are replaced by `default`.
+    The data keys are unwrapped inside the parallel chunks, next to the decryption.
+    """
+    items = list(encrypted_items)
+    key_ids = list(key_ids)
+    wrapped_keys = list(wrapped_keys) if wrapped_keys is not None else [None] * len(items)
+    # The keyring reads the database: load it here, on the caller's connection
+    keyring = get_keyring(master_key)
+    return _map_chunks(lambda chunk: _decrypt_keyed_chunk(chunk, keyring, default),
+                       list(zip(items, key_ids, wrapped_keys)))
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def search_index_keys(key: bytes):
+    """
+    Derive the persistent search index subkeys from an encryption key.
+    Returns (token_key, aead): the HMAC key that turns terms into opaque tokens,
+    and the AES-GCM cipher that seals posting lists.
+    """
+    token_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                     info=b"securenotes/search/token").derive(key)
+    postings_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                        info=b"securenotes/search/postings").derive(key)
+    return token_key, AESGCM(postings_key)
+
+def clear_cipher_cache():
+    """
+    Drop every cached cipher object and derived subkey (call on lock/logout).
+    """
+    get_fernet.cache_clear()
+    get_cipher.cache_clear()
+    _blind_index_key.cache_clear()
+    search_index_keys.cache_clear()
+    get_keyring.cache_clear()
+    _key_wrapping_key.cache_clear()
+    unwrap_data_key.cache_clear()
+
+def clear_session_caches():
+    """
+    Drop everything cached for the unlocked session: ciphers and decrypted titles.
+    """
+    clear_cipher_cache()
+    title_cache.clear()
+
 def encrypt_string(data: str, key: bytes) -> bytes:
     """
     Encrypt a string using the provided key.
-    Returns encrypted bytes.
+    Returns the binary envelope (bytes).
     """
-    return get_fernet(key).encrypt(data.encode())
+    return _as_cipher(key).encrypt(data.encode())
 
 def decrypt_string(encrypted_data: bytes, key: bytes) -> str:
     """
-    Decrypt bytes using the provided key.
+    Decrypt a binary envelope or a legacy Fernet token using the provided key.
     Returns the original string.
     """
-    return get_fernet(key).decrypt(encrypted_data).decode()
+    return _as_cipher(key).decrypt(encrypted_data).decode()
+
+_crypto_executor = None
+_crypto_executor_workers = None
+_crypto_executor_lock = threading.Lock()
+
+def _get_crypto_executor(workers: int) -> ThreadPoolExecutor:
+    """
+    Return the shared encryption/decryption thread pool, rebuilding it if the worker count changed.
+    """
+    global _crypto_executor, _crypto_executor_workers
+    with _crypto_executor_lock:
+        if _crypto_executor is None or _crypto_executor_workers != workers:
+            if _crypto_executor is not None:
+                _crypto_executor.shutdown(wait=False)
+            _crypto_executor = ThreadPoolExecutor(max_workers=workers,
+                                                  thread_name_prefix="crypto")
+            _crypto_executor_workers = workers
+        return _crypto_executor
+
+def _map_chunks(func, items: list, workers: int = None, chunk_size: int = None) -> list:
+    """
+    Apply func (list -> list) to items, in parallel chunks for large batches,
+    and return the concatenated results in order.
+    """
+    workers = workers or config.DECRYPT_WORKERS or os.cpu_count() or 1
+    chunk_size = chunk_size or config.DECRYPT_CHUNK_SIZE
+
+    if workers <= 1 or len(items) < config.PARALLEL_DECRYPT_THRESHOLD:
+        return func(items)
+
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    executor = _get_crypto_executor(workers)
+    result = []
+    for processed in executor.map(func, chunks):
+        result.extend(processed)
+    return result
+
+def _decrypt_chunk(chunk, key: bytes, default):
+    cipher = _as_cipher(key)
+    result = []
+    for encrypted_data in chunk:
+        try:
+            result.append(cipher.decrypt(encrypted_data).decode())
+        except Exception:
+            result.append(default)
+    return result
+
+def _encrypt_chunk(chunk, key: bytes):
+    cipher = _as_cipher(key)
+    return [cipher.encrypt(data.encode()) for data in chunk]
+
+def _decrypt_pairs_chunk(chunk, default):
+    result = []
+    for encrypted_data, key in chunk:
+        if key is None:
+            result.append(default)
+            continue
+        try:
+            result.append(_as_cipher(key).decrypt(encrypted_data).decode())
+        except Exception:
+            result.append(default)
+    return result
+
+def _decrypt_keyed_chunk(chunk, keyring, default):
+    result = []
+    for encrypted_data, key_id, wrapped_key in chunk:
+        try:
+            cipher = _keyring_cipher(keyring, key_id, wrapped_key)
+            result.append(cipher.decrypt(encrypted_data).decode())
+        except Exception:
+            result.append(default)
+    return result
+
+def _encrypt_pairs_chunk(chunk):
+    return [_as_cipher(key).encrypt(data.encode()) for data, key in chunk]
+
+def decrypt_strings(encrypted_items, key: bytes, default: str = None,
+                    workers: int = None, chunk_size: int = None) -> list:
+    """
+    Decrypt many ciphertexts with the same key, preserving order.
+    Items that fail to decrypt are replaced by `default`.
+    Batches of at least config.PARALLEL_DECRYPT_THRESHOLD items are split into chunks
+    and decrypted on a thread pool (the crypto backend releases the GIL).
+    """
+    return _map_chunks(lambda chunk: _decrypt_chunk(chunk, key, default),
+                       list(encrypted_items), workers, chunk_size)
+
+def encrypt_strings(items, key: bytes, workers: int = None, chunk_size: int = None) -> list:
+    """
+    Encrypt many strings with the same key, preserving order.
+    Large batches are encrypted on the same thread pool as decrypt_strings.
+    """
+    return _map_chunks(lambda chunk: _encrypt_chunk(chunk, key),
+                       list(items), workers, chunk_size)
+
+def decrypt_strings_with_keys(encrypted_items, keys, default: str = None,
+                              workers: int = None, chunk_size: int = None) -> list:
+    """
+    Like decrypt_strings, with its own key (or cipher) for every item,
+    e.g. each note's data key. A None key gives `default`.
+    """
+    pairs = list(zip(encrypted_items, keys))
+    return _map_chunks(lambda chunk: _decrypt_pairs_chunk(chunk, default),
+                       pairs, workers, chunk_size)
+
+def encrypt_strings_with_keys(items, keys, workers: int = None, chunk_size: int = None) -> list:
+    """
+    Like encrypt_strings, with its own key (or cipher) for every item.
+    """
+    return _map_chunks(_encrypt_pairs_chunk, list(zip(items, keys)), workers, chunk_size)
+
+class TitleCache:
+    """
+    Size-bounded LRU of note_id -> decrypted title for the unlocked session.
+    Each entry remembers the ciphertext it was decrypted from and only hits
+    for that exact ciphertext, so a missed invalidation can never serve a stale title.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, note_id, ciphertext):
+        with self._lock:
+            entry = self._entries.get(note_id)
+            if entry is None or entry[0] != ciphertext:
+                return None
+            self._entries.move_to_end(note_id)
+            return entry[1]
+
+    def put(self, note_id, ciphertext, title: str):
+        with self._lock:
+            self._entries[note_id] = (ciphertext, title)
+            self._entries.move_to_end(note_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, note_id):
+        with self._lock:
+            self._entries.pop(note_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+title_cache = TitleCache(config.TITLE_CACHE_SIZE)
 
 def load_master_key() -> bytes:
     """
     Load the master key from the SQLite database, or generate & save it if not present.
     Returns the key (bytes).
     """
-    conn = database.create_connection()
-    if conn is None:
-        raise RuntimeError("Cannot connect to database to load/generate master key.")
-    cursor = conn.cursor()
+    with database.transaction() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT password_hash FROM master_key LIMIT 1")
-    row = cursor.fetchone()
+        cursor.execute("SELECT password_hash FROM master_key LIMIT 1")
+        row = cursor.fetchone()
 
-    if row:
-        key = row[0].encode()
-        print("🔑 Master key loaded.")
-    else:
-        key = generate_key()
-        cursor.execute(
-            "INSERT INTO master_key (password_hash) VALUES (?)",
-            (key.decode(),)
-        )
-        conn.commit()
-        print("🆕 Master key generated and saved.")
-
-    cursor.close()
-    conn.close()
+        if row:
+            key = row[0].encode()
+            print("🔑 Master key loaded.")
+        else:
+            key = generate_key()
+            cursor.execute(
+                "INSERT INTO master_key (password_hash) VALUES (?)",
+                (key.decode(),)
+            )
+            print("🆕 Master key generated and saved.")
+
+        cursor.close()
     return key
 
 def create_note(title: str, content: str, key: bytes,
@@ -71,37 +826,57 @@ def create_note(title: str, content: str, key: bytes,
     - max_opens: int or None
     - is_reflection, blind_mode: boolean flags
     """
-    encrypted_title = encrypt_string(title, key)
-    encrypted_content = encrypt_string(content, key)
+    data_key, wrapped_key, key_id = new_data_key(key)
+    encrypted_title = encrypt_string(title, data_key)
+    encrypted_content = encrypt_string(content, data_key)
 
-    expires_str = None
-    if expires_at:
-        if isinstance(expires_at, datetime):
-            expires_str = expires_at.isoformat(sep=' ')
-        else:
-            expires_str = str(expires_at)
+    expires_str = normalize_expires_at(expires_at)
 
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         print("❌ Cannot create note: no DB connection.")
         return
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """
-            INSERT INTO notes
-                (title, content, expires_at, max_opens, is_reflection, blind_mode)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (encrypted_title, encrypted_content, expires_str, max_opens, int(is_reflection), int(blind_mode))
-        )
-        conn.commit()
+        with database.transaction():
+            cursor = conn.execute(
+                """
+                INSERT INTO notes
+                    (title, title_index, wrapped_key, key_id, expires_at, max_opens, is_reflection, blind_mode)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (encrypted_title, title_blind_index(title, get_index_key(key)), wrapped_key, key_id,
+                 expires_str, max_opens, int(is_reflection), int(blind_mode))
+            )
+            check_current_key(conn, key_id)
+            conn.execute(
+                "INSERT INTO note_contents (note_id, content) VALUES (?, ?)",
+                (cursor.lastrowid, encrypted_content)
+            )
+        title_cache.put(cursor.lastrowid, encrypted_title, title)
         print("📝 Note created.")
     except Exception as e:
         print(f"❌ Failed to create note: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+
+# SQL form of should_delete_note's expiry test, taking the current time as its
+# parameter. Times are compared as julianday() values, so "T" and " " separators
+# agree; an unparseable expires_at gives NULL and never counts as expired.
+EXPIRED_SQL = "(expires_at IS NOT NULL AND julianday(expires_at) < julianday(?))"
+NOT_EXPIRED_SQL = f"NOT COALESCE({EXPIRED_SQL}, 0)"
+
+def normalize_expires_at(value):
+    """
+    Return an expiry (datetime or ISO 8601 string) as the naive local-time
+    "YYYY-MM-DD HH:MM:SS" string notes store, or None for no expiry. Values with
+    a UTC offset are converted to local time first, so EXPIRED_SQL compares them
+    with the local current time correctly. Raises ValueError if unparseable.
+    """
+    if not value:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value.isoformat(sep=' ')
 
 def should_delete_note(note_row: dict) -> bool:
     now = datetime.now()
@@ -132,42 +907,35 @@ def should_delete_note(note_row: dict) -> bool:
     return False
 
 def increment_open_count(note_id: int):
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         print("❌ Cannot increment open_count: no DB connection.")
         return
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            "UPDATE notes SET open_count = open_count + 1 WHERE id = ?",
-            (note_id,)
-        )
-        cursor.execute(
-            "UPDATE notes SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (note_id,)
-        )
-        conn.commit()
+        with database.transaction():
+            conn.execute(
+                "UPDATE notes SET open_count = open_count + 1 WHERE id = ?",
+                (note_id,)
+            )
+            conn.execute(
+                "UPDATE notes SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (note_id,)
+            )
     except Exception as e:
         print(f"⚠️ Error incrementing open_count for note {note_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
 
 def mark_note_deleted(note_id: int):
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         print("❌ Cannot delete note: no DB connection.")
         return
-    cursor = conn.cursor()
     try:
-        cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-        conn.commit()
+        with database.transaction():
+            conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+        title_cache.invalidate(note_id)
         print(f"🗑️ Note {note_id} deleted.")
     except Exception as e:
         print(f"⚠️ Error deleting note {note_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
 
 def is_blind_mode_enabled(note_row: dict) -> bool:
     return bool(note_row.get("blind_mode"))
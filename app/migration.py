@@ -0,0 +1,146 @@
+import os
+import json
+from database import database
+from app.notes import create_notes
+from app.gui.crypto_utils import decrypt_note, generate_key_from_password
+from app.gui.note_store import JournaledNoteStore
+
+# Notes encrypted and written per create_notes call by the JSON importer
+MIGRATION_BATCH_SIZE = 500
+_READ_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_json_array(f):
+    """
+    Yield the elements of a top-level JSON array from an open text file one at
+    a time, reading it in chunks instead of loading it whole.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # Skip whitespace, separators and the opening bracket
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","
+                                  or (buf[pos] == "[" and not started)):
+            started = started or buf[pos] == "["
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        if pos < len(buf) and started:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                yield item
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            return
+        chunk = f.read(_READ_CHUNK_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def migrate_json_notes(json_path: str, password: str, master_key: bytes,
+                       batch_size: int = MIGRATION_BATCH_SIZE, progress=None) -> int:
+    """
+    Import the GUI's legacy notes_data.json into the SQLite notes table.
+    Notes are decrypted with the legacy GUI key (derived from `password`),
+    re-encrypted under `master_key`, and written with create_notes `batch_size`
+    notes at a time, all in one transaction, so an import that fails partway
+    leaves nothing behind to be imported twice. A pending journal is folded into
+    the snapshot first. If every note was imported the JSON file is renamed to
+    `<json_path>.migrated`; otherwise it is rewritten with only the notes that
+    could not be decrypted, so they can be retried (with another password).
+
+    :param json_path: Path of the legacy notes_data.json.
+    :param password: The master password the legacy notes were encrypted with.
+    :param master_key: The Fernet key (bytes) to re-encrypt under.
+    :param batch_size: Notes per create_notes call.
+    :param progress: Optional callable(imported_count, bytes_read_fraction) called after each batch.
+    :return: The number of notes imported.
+    """
+    store = JournaledNoteStore(json_path)
+    if os.path.exists(store.journal_path):
+        store.compact(store.load())
+    if not os.path.exists(json_path):
+        return 0
+
+    legacy_key = generate_key_from_password(password)
+    total_size = os.path.getsize(json_path) or 1
+    imported = 0
+    unreadable = []
+    batch = []
+
+    with open(json_path, "r", encoding="utf-8") as f, database.transaction(immediate=True):
+        def flush():
+            nonlocal imported
+            imported += create_notes(batch, master_key, chunk_size=batch_size)
+            batch.clear()
+            if progress is not None:
+                progress(imported, min(1.0, f.buffer.tell() / total_size))
+
+        for note in _iter_json_array(f):
+            try:
+                title = decrypt_note(note["title"], legacy_key)
+                content = decrypt_note(note["content_encrypted"], legacy_key)
+            except Exception:
+                unreadable.append(note)
+                continue
+            max_reads = note.get("max_reads")
+            open_count = note.get("read_count", 0)
+            if max_reads is not None:
+                open_count = min(open_count, max_reads)
+            batch.append({
+                "title": title,
+                "content": content,
+                "open_count": open_count,
+                "max_opens": max_reads,
+            })
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+    if unreadable:
+        if imported:
+            store.compact(unreadable)
+        print(f"⚠️ Imported {imported} note(s) from {json_path}; "
+              f"{len(unreadable)} could not be decrypted and were kept there.")
+        return imported
+
+    os.replace(json_path, json_path + ".migrated")
+    print(f"📦 Imported {imported} note(s) from {json_path}.")
+    return imported
+
+
+def legacy_password_matches(json_path: str, password: str) -> bool:
+    """
+    Tell whether `password` opens the legacy notes_data.json: True if the file
+    has no notes or at least one of them decrypts with it. Checked before a
+    vault is created from the file, so a mistyped password is not taken as the
+    new master password.
+
+    :param json_path: Path of the legacy notes_data.json.
+    :param password: The password to try.
+    :return: True if the password matches (or there is nothing to decrypt).
+    """
+    store = JournaledNoteStore(json_path)
+    if os.path.exists(store.journal_path):
+        store.compact(store.load())
+    if not os.path.exists(json_path):
+        return True
+    legacy_key = generate_key_from_password(password)
+    empty = True
+    with open(json_path, "r", encoding="utf-8") as f:
+        for note in _iter_json_array(f):
+            empty = False
+            try:
+                decrypt_note(note["title"], legacy_key)
+                return True
+            except Exception:
+                continue
+    return empty
@@ -1,11 +1,33 @@
+import io
+import os
+import sqlite3
+import threading
+import config
+from itertools import islice
 from datetime import datetime
 from database import database
+from app import search
 from app.logic import (
     encrypt_string,
     decrypt_string,
-    should_delete_note,
-    increment_open_count,
-    mark_note_deleted
+    encrypt_strings_with_keys,
+    to_envelope,
+    needs_reencryption,
+    LEGACY_TOKEN_PREFIX,
+    title_blind_index,
+    title_cache,
+    EXPIRED_SQL,
+    NOT_EXPIRED_SQL,
+    normalize_expires_at,
+    encrypt_stream,
+    decrypt_stream,
+    stream_ciphertext_size,
+    get_index_key,
+    new_data_key,
+    check_current_key,
+    row_cipher,
+    decrypt_strings_keyed,
+    InvalidToken
 )
 
 def create_note(title: str, content: str, master_key: bytes,
@@ -23,102 +45,217 @@ def create_note(title: str, content: str, master_key: bytes,
     :param max_opens: Optional int maximum number of opens before auto-delete.
     :param is_reflection: If True, this note uses “reflection mode” logic.
     :param blind_mode: If True, this note uses “blind mode” logic.
+    :return: The new note's ID. Errors (including a too-large content) are raised.
     """
-    # Encrypt title and content
-    encrypted_title = encrypt_string(title, master_key)
-    encrypted_content = encrypt_string(content, master_key)
+    # Encrypt the title under a fresh data key and compute its blind index; the
+    # content is encrypted as it is written, streamed in segments if it is large
+    data_key, wrapped_key, key_id = new_data_key(master_key)
+    encrypted_title = encrypt_string(title, data_key)
+    title_index = title_blind_index(title, get_index_key(master_key))
 
-    # Prepare expires_at as ISO string or None
-    expires_str = None
-    if expires_at:
-        if isinstance(expires_at, datetime):
-            expires_str = expires_at.isoformat(sep=' ')
-        else:
-            expires_str = str(expires_at)
+    # Prepare expires_at as a normalized ISO string or None
+    expires_str = normalize_expires_at(expires_at)
 
     # Convert booleans to integers for SQLite (0 or 1)
     reflection_flag = 1 if is_reflection else 0
     blind_flag = 1 if blind_mode else 0
 
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         raise RuntimeError("Cannot connect to database to create note.")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+    with database.transaction():
+        cursor = conn.execute("""
             INSERT INTO notes
-                (title, content, created_at, updated_at, open_count, max_opens, expires_at, is_reflection, blind_mode)
-            VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0, ?, ?, ?, ?)
-        """, (encrypted_title, encrypted_content, max_opens, expires_str, reflection_flag, blind_flag))
-        conn.commit()
-        print(f"Note created with title (encrypted).")
-    except Exception as e:
-        print(f"Error creating note: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+                (title, title_index, wrapped_key, key_id, created_at, updated_at, open_count, max_opens, expires_at, is_reflection, blind_mode)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0, ?, ?, ?, ?)
+        """, (encrypted_title, title_index, wrapped_key, key_id,
+              max_opens, expires_str, reflection_flag, blind_flag))
+        check_current_key(conn, key_id)
+        _write_content(conn, cursor.lastrowid, content, data_key)
+        search.index_note_terms(conn, [(cursor.lastrowid, _search_text(title, content))], master_key)
+    title_cache.put(cursor.lastrowid, encrypted_title, title)
+    search.index_note(cursor.lastrowid, title, content)
+    print(f"Note created with title (encrypted).")
+    return cursor.lastrowid
 
 
-def read_note(note_id: int, master_key: bytes):
+def read_note(note_id: int, master_key: bytes, count_open: bool = True):
     """
-    Read a note by ID:
-    - If the note should auto-delete (due to max_opens or expiration), delete it and return {'deleted': True}.
-    - Otherwise, increment open_count, decrypt and return note data.
+    Read a note by ID, consuming one open atomically (unless count_open is False):
+    - A single UPDATE ... RETURNING bumps open_count and returns the row, but only
+      if the note is neither expired nor out of opens.
+    - If the note exists but is expired or exhausted, it is deleted and {'deleted': True} is returned.
+    - If this read uses the last allowed open, the note is deleted in the same transaction
+      and its content is still returned.
+    This is the only call that loads a note's content; list_notes reads metadata only.
     
     :param note_id: ID of the note to read.
     :param master_key: The Fernet key (bytes) used for decryption.
+    :param count_open: If False, the note is read without using up an open.
     :return: A dict with decrypted fields and metadata, or {'deleted': True}, or None if not found.
     """
-    conn = database.create_connection()
-    if conn is None:
-        raise RuntimeError("Cannot connect to database to read note.")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
-        row = cursor.fetchone()
-        if not row:
-            # Note not found
-            return None
-
-        note_row = dict(row)
+    now_str = datetime.now().isoformat(sep=' ')
+    # Without counting, the SET is a no-op and the statement only checks liveness
+    open_increment = 1 if count_open else 0
+    with database.transaction(immediate=True) as conn:
+        rows = conn.execute(f"""
+            UPDATE notes
+            SET open_count = open_count + ?,
+                updated_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE updated_at END
+            WHERE id = ?
+              AND (max_opens IS NULL OR open_count < max_opens)
+              AND {NOT_EXPIRED_SQL}
+            RETURNING id, title, key_id, wrapped_key, created_at, updated_at, open_count,
+                      max_opens, expires_at, is_reflection, blind_mode
+        """, (open_increment, open_increment, note_id, now_str)).fetchall()
 
-        if should_delete_note(note_row):
-            mark_note_deleted(note_id)
+        if not rows:
+            deleted = conn.execute("DELETE FROM notes WHERE id = ?", (note_id,)).rowcount
+            if deleted:
+                search.index_note_terms(conn, [(note_id, None)], master_key)
+            title_cache.invalidate(note_id)
+            search.unindex_note(note_id)
+            if not deleted:
+                # Note not found
+                return None
             print(f"Note {note_id} auto-deleted.")
             return {"deleted": True}
 
-        
-        increment_open_count(note_id)
-
-        # Decrypt title and content
+        note_row = dict(rows[0])
+        # The note's data key, or for notes written before data keys the
+        # (possibly older) master key it was encrypted under
         try:
-            decrypted_title = decrypt_string(note_row["title"], master_key)
-        except Exception:
-            decrypted_title = "<Decryption Error>"
+            note_key = row_cipher(note_row["key_id"], note_row["wrapped_key"], master_key)
+        except InvalidToken:
+            note_key = master_key
+        # Streamed contents are decrypted from their blob instead of being loaded whole
+        content_row = conn.execute("""
+            SELECT streamed, CASE WHEN streamed THEN NULL ELSE content END AS content
+            FROM note_contents WHERE note_id = ?
+        """, (note_id,)).fetchone()
+        note_row["content"] = content_row["content"] if content_row else None
+        streamed_content = None
+        if content_row is not None and content_row["streamed"]:
+            streamed_content = _read_streamed_content(conn, note_id, note_key)
+        max_opens = note_row.get("max_opens")
+        note_deleted = max_opens is not None and note_row["open_count"] >= max_opens
+        if note_deleted:
+            # Last allowed read: the note self-destructs in this same transaction
+            conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            search.index_note_terms(conn, [(note_id, None)], master_key)
+            title_cache.invalidate(note_id)
+            search.unindex_note(note_id)
+            print(f"Note {note_id} auto-deleted after its last allowed read.")
 
+    # Decrypt title and content
+    try:
+        decrypted_title = decrypt_string(note_row["title"], note_key)
+    except Exception:
+        decrypted_title = None
+
+    decrypted_content = streamed_content
+    if decrypted_content is None:
         try:
-            decrypted_content = decrypt_string(note_row["content"], master_key)
+            decrypted_content = decrypt_string(note_row["content"], note_key)
         except Exception:
-            decrypted_content = "<Decryption Error>"
+            # Also covers a missing content row
+            decrypted_content = None
 
-        # Build result with metadata
-        result = {
-            "id": note_id,
-            "title": decrypted_title,
-            "content": decrypted_content,
-            "created_at": note_row.get("created_at"),
-            "updated_at": datetime.now(),
-            "open_count": note_row.get("open_count", 0) + 1,
-            "max_opens": note_row.get("max_opens"),
-            "expires_at": note_row.get("expires_at"),
-            "is_reflection": bool(note_row.get("is_reflection")),
-            "blind_mode": bool(note_row.get("blind_mode")),
-            "deleted": False
-        }
-        return result
-    finally:
-        cursor.close()
-        conn.close()
+    # Notes without a data key are left to the rotation job, which gives them one
+    if (not note_deleted and note_row["wrapped_key"] is not None
+            and decrypted_title is not None and decrypted_content is not None):
+        _reencrypt_if_outdated(note_row, decrypted_title, decrypted_content, note_key)
+    if decrypted_title is None:
+        decrypted_title = "<Decryption Error>"
+    if decrypted_content is None:
+        decrypted_content = "<Decryption Error>"
+
+    # Build result with metadata
+    result = {
+        "id": note_id,
+        "title": decrypted_title,
+        "content": decrypted_content,
+        "created_at": note_row.get("created_at"),
+        "updated_at": note_row.get("updated_at"),
+        "open_count": note_row.get("open_count"),
+        "max_opens": max_opens,
+        "expires_at": note_row.get("expires_at"),
+        "is_reflection": bool(note_row.get("is_reflection")),
+        "blind_mode": bool(note_row.get("blind_mode")),
+        "deleted": False
+    }
+    return result
+
+
+def _reencrypt_if_outdated(note_row: dict, title: str, content: str, note_key):
+    """
+    Lazily move a note to the current cipher engine the first time it is read,
+    keeping its data key (`note_key` is the note's cipher).
+    Each UPDATE only applies if the row still holds the ciphertext we decrypted.
+    """
+    if needs_reencryption(note_row["title"], note_key):
+        encrypted_title = encrypt_string(title, note_key)
+        with database.transaction() as conn:
+            updated = conn.execute(
+                "UPDATE notes SET title = ? WHERE id = ? AND title = ?",
+                (encrypted_title, note_row["id"], note_row["title"])
+            ).rowcount
+        if updated:
+            title_cache.put(note_row["id"], encrypted_title, title)
+    # Streamed contents (content is None here) are already in the current format
+    if note_row["content"] is not None and needs_reencryption(note_row["content"], note_key):
+        with database.transaction() as conn:
+            conn.execute(
+                "UPDATE note_contents SET content = ? WHERE note_id = ? AND content = ?",
+                (encrypt_string(content, note_key), note_row["id"], note_row["content"])
+            )
+
+
+def _search_text(title: str, content: str) -> str:
+    """
+    The text a note is indexed under by the persistent search index.
+    """
+    return f"{title}\n{content}"
+
+
+def _write_content(conn, note_id: int, content: str, key,
+                   encrypted_content: bytes = None):
+    """
+    Store (or replace) a note's content inside the caller's transaction.
+    Contents of at least config.STREAM_THRESHOLD bytes are encrypted segment by
+    segment straight into the row's blob, so their ciphertext is never held in
+    memory; smaller ones are stored in one piece (`encrypted_content` if given).
+    """
+    data = content.encode()
+    if len(data) < config.STREAM_THRESHOLD:
+        conn.execute(
+            "INSERT OR REPLACE INTO note_contents (note_id, content, streamed) VALUES (?, ?, 0)",
+            (note_id, encrypted_content or encrypt_string(content, key))
+        )
+        return
+    blob_size = stream_ciphertext_size(len(data))
+    if blob_size > conn.getlimit(sqlite3.SQLITE_LIMIT_LENGTH):
+        raise ValueError(f"Note content too large: {len(data)} bytes.")
+    conn.execute(
+        "INSERT OR REPLACE INTO note_contents (note_id, content, streamed) VALUES (?, zeroblob(?), 1)",
+        (note_id, blob_size)
+    )
+    with conn.blobopen("note_contents", "content", note_id) as blob:
+        encrypt_stream(io.BytesIO(data), blob, key)
+
+
+def _read_streamed_content(conn, note_id: int, key):
+    """
+    Decrypt a streamed note content segment by segment from its blob.
+    Returns the plaintext, or None if it cannot be decrypted.
+    """
+    plaintext = io.BytesIO()
+    try:
+        with conn.blobopen("note_contents", "content", note_id, readonly=True) as blob:
+            decrypt_stream(blob, plaintext, key)
+        return plaintext.getvalue().decode()
+    except Exception:
+        return None
 
 
 def update_note(note_id: int, title: str, content: str, master_key: bytes,
@@ -137,102 +274,731 @@ def update_note(note_id: int, title: str, content: str, master_key: bytes,
     :param max_opens: Optional int maximum number of opens.
     :param is_reflection: If True, enable reflection mode.
     :param blind_mode: If True, enable blind mode.
+    :return: True if the note was updated, False if it does not exist. Errors are raised.
     """
     
-    encrypted_title = encrypt_string(title, master_key)
-    encrypted_content = encrypt_string(content, master_key)
+    # Every update gets a fresh data key
+    data_key, wrapped_key, key_id = new_data_key(master_key)
+    encrypted_title = encrypt_string(title, data_key)
+    title_index = title_blind_index(title, get_index_key(master_key))
 
-    expires_str = None
-    if expires_at:
-        if isinstance(expires_at, datetime):
-            expires_str = expires_at.isoformat(sep=' ')
-        else:
-            expires_str = str(expires_at)
+    expires_str = normalize_expires_at(expires_at)
 
     reflection_flag = 1 if is_reflection else 0
     blind_flag = 1 if blind_mode else 0
 
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         raise RuntimeError("Cannot connect to database to update note.")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+    with database.transaction():
+        updated = conn.execute("""
             UPDATE notes
-            SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP,
+            SET title = ?, title_index = ?, wrapped_key = ?, key_id = ?, updated_at = CURRENT_TIMESTAMP,
                 max_opens = ?, expires_at = ?, is_reflection = ?, blind_mode = ?
             WHERE id = ?
-        """, (encrypted_title, encrypted_content, max_opens, expires_str, reflection_flag, blind_flag, note_id))
-        conn.commit()
-        print(f"Note {note_id} updated.")
-    except Exception as e:
-        print(f"Error updating note {note_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        """, (encrypted_title, title_index, wrapped_key, key_id,
+              max_opens, expires_str, reflection_flag, blind_flag, note_id)).rowcount
+        check_current_key(conn, key_id)
+        if updated:
+            _write_content(conn, note_id, content, data_key)
+            search.index_note_terms(conn, [(note_id, _search_text(title, content))], master_key)
+    if not updated:
+        return False
+    title_cache.put(note_id, encrypted_title, title)
+    search.index_note(note_id, title, content)
+    print(f"Note {note_id} updated.")
+    return True
 
 
-def delete_note(note_id: int):
+def delete_note(note_id: int, master_key: bytes):
     """
-    Delete a note by ID.
+    Delete a note by ID, removing it from the search index in the same transaction.
     
     :param note_id: ID of the note to delete.
+    :param master_key: The Fernet key (bytes); the persistent search index needs it.
+    :return: True if the note was deleted, False if it does not exist. Errors are raised.
     """
-    conn = database.create_connection()
+    conn = database.get_connection()
     if conn is None:
         raise RuntimeError("Cannot connect to database to delete note.")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-        conn.commit()
-        print(f"Note {note_id} deleted.")
-    except Exception as e:
-        print(f"Error deleting note {note_id}: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    with database.transaction():
+        deleted = conn.execute("DELETE FROM notes WHERE id = ?", (note_id,)).rowcount
+        if deleted:
+            search.index_note_terms(conn, [(note_id, None)], master_key)
+    title_cache.invalidate(note_id)
+    search.unindex_note(note_id)
+    if not deleted:
+        return False
+    print(f"Note {note_id} deleted.")
+    return True
 
 
-def list_notes(master_key: bytes):
+def _chunked(iterable, size: int):
     """
-    List all notes, decrypting only the title for display in a list.
+    Yield lists of up to `size` items from any iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _encrypt_note_fields(chunk: list, master_key: bytes):
+    """
+    Give each note of a chunk a fresh data key and encrypt the titles and
+    contents in one parallel pass.
+    Contents large enough to be streamed are left to _write_content (None here).
+    Returns (encrypted_titles, encrypted_contents, title_indexes, data_keys),
+    data_keys holding new_data_key's (cipher, wrapped_key, key_id) per note.
+    """
+    data_keys = [new_data_key(master_key) for _ in chunk]
+    small = [i for i, note in enumerate(chunk)
+             if len(note["content"].encode()) < config.STREAM_THRESHOLD]
+    encrypted = encrypt_strings_with_keys(
+        [note["title"] for note in chunk] + [chunk[i]["content"] for i in small],
+        [data_key for data_key, _, _ in data_keys] + [data_keys[i][0] for i in small]
+    )
+    contents = [None] * len(chunk)
+    for i, encrypted_content in zip(small, encrypted[len(chunk):]):
+        contents[i] = encrypted_content
+    index_key = get_index_key(master_key)
+    title_indexes = [title_blind_index(note["title"], index_key) for note in chunk]
+    return encrypted[:len(chunk)], contents, title_indexes, data_keys
+
+
+def create_notes(new_notes, master_key: bytes, chunk_size: int = None) -> int:
+    """
+    Create many notes in a single transaction.
+    Each chunk is encrypted in parallel. The notes rows are inserted one cached
+    statement per note, since each new id is needed for its content row and
+    search entry (executemany does not report them); the contents are then
+    written with one executemany call per chunk.
+    
+    :param new_notes: Iterable of dicts with keys title, content and optionally
+        expires_at, max_opens, is_reflection, blind_mode, open_count.
+    :param master_key: The Fernet key (bytes) used for encryption.
+    :param chunk_size: Notes encrypted and written per chunk; defaults to config.BATCH_CHUNK_SIZE.
+    :return: The number of notes created.
+    """
+    chunk_size = chunk_size or config.BATCH_CHUNK_SIZE
+    created = 0
+    indexed = []
+    with database.transaction() as conn:
+        for chunk in _chunked(new_notes, chunk_size):
+            titles, contents, title_indexes, data_keys = _encrypt_note_fields(chunk, master_key)
+            rows = [
+                (titles[i], title_indexes[i], data_keys[i][1], data_keys[i][2],
+                 note.get("open_count", 0), note.get("max_opens"),
+                 normalize_expires_at(note.get("expires_at")),
+                 1 if note.get("is_reflection") else 0,
+                 1 if note.get("blind_mode") else 0)
+                for i, note in enumerate(chunk)
+            ]
+            # One INSERT per note (cached statement) to learn each new id
+            note_ids = [
+                conn.execute("""
+                    INSERT INTO notes
+                        (title, title_index, wrapped_key, key_id, created_at, updated_at, open_count, max_opens, expires_at, is_reflection, blind_mode)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, ?, ?, ?, ?)
+                """, row).lastrowid
+                for row in rows
+            ]
+            check_current_key(conn, data_keys[0][2])
+            conn.executemany("INSERT INTO note_contents (note_id, content) VALUES (?, ?)",
+                             [(note_id, content) for note_id, content in zip(note_ids, contents)
+                              if content is not None])
+            for note_id, note, content, (data_key, _, _) in zip(note_ids, chunk, contents, data_keys):
+                if content is None:
+                    _write_content(conn, note_id, note["content"], data_key)
+            search.index_note_terms(
+                conn,
+                [(note_id, _search_text(note["title"], note["content"])) for note_id, note in zip(note_ids, chunk)],
+                master_key
+            )
+            indexed.extend((note_id, note["title"], note["content"]) for note_id, note in zip(note_ids, chunk))
+            created += len(rows)
+    search.index_notes(indexed)
+    print(f"{created} note(s) created.")
+    return created
+
+
+def update_notes(changed_notes, master_key: bytes, chunk_size: int = None) -> int:
+    """
+    Update many notes in a single transaction, like update_note for each one.
+    
+    :param changed_notes: Iterable of dicts with keys id, title, content and optionally
+        expires_at, max_opens, is_reflection, blind_mode.
+    :param master_key: The Fernet key (bytes) used for encryption.
+    :param chunk_size: Notes per executemany call; defaults to config.BATCH_CHUNK_SIZE.
+    :return: The number of notes updated.
+    """
+    chunk_size = chunk_size or config.BATCH_CHUNK_SIZE
+    updated = 0
+    cache_entries = []
+    indexed = []
+    with database.transaction() as conn:
+        for chunk in _chunked(changed_notes, chunk_size):
+            titles, contents, title_indexes, data_keys = _encrypt_note_fields(chunk, master_key)
+            rows = [
+                (titles[i], title_indexes[i], data_keys[i][1], data_keys[i][2], note.get("max_opens"),
+                 normalize_expires_at(note.get("expires_at")),
+                 1 if note.get("is_reflection") else 0,
+                 1 if note.get("blind_mode") else 0,
+                 note["id"])
+                for i, note in enumerate(chunk)
+            ]
+            cursor = conn.executemany("""
+                UPDATE notes
+                SET title = ?, title_index = ?, wrapped_key = ?, key_id = ?, updated_at = CURRENT_TIMESTAMP,
+                    max_opens = ?, expires_at = ?, is_reflection = ?, blind_mode = ?
+                WHERE id = ?
+            """, rows)
+            check_current_key(conn, data_keys[0][2])
+            updated += cursor.rowcount
+            conn.executemany("UPDATE note_contents SET content = ?, streamed = 0 WHERE note_id = ?",
+                             [(contents[i], note["id"]) for i, note in enumerate(chunk)
+                              if contents[i] is not None])
+            existing = [i for i, note in enumerate(chunk)
+                        if conn.execute("SELECT 1 FROM notes WHERE id = ?", (note["id"],)).fetchone()]
+            for i in existing:
+                if contents[i] is None:
+                    _write_content(conn, chunk[i]["id"], chunk[i]["content"], data_keys[i][0])
+            search.index_note_terms(
+                conn,
+                [(chunk[i]["id"], _search_text(chunk[i]["title"], chunk[i]["content"])) for i in existing],
+                master_key
+            )
+            cache_entries.extend((note["id"], titles[i], note["title"]) for i, note in enumerate(chunk))
+            indexed.extend((chunk[i]["id"], chunk[i]["title"], chunk[i]["content"]) for i in existing)
+    for note_id, encrypted_title, title in cache_entries:
+        title_cache.put(note_id, encrypted_title, title)
+    search.index_notes(indexed)
+    print(f"{updated} note(s) updated.")
+    return updated
+
+
+def delete_notes(note_ids, master_key: bytes, chunk_size: int = None) -> int:
+    """
+    Delete many notes by ID in a single transaction, removing them from the
+    search index in the same transaction.
+    
+    :param note_ids: Iterable of note IDs.
+    :param master_key: The Fernet key (bytes); the persistent search index needs it.
+    :param chunk_size: IDs per executemany call; defaults to config.BATCH_CHUNK_SIZE.
+    :return: The number of notes deleted.
+    """
+    chunk_size = chunk_size or config.BATCH_CHUNK_SIZE
+    deleted = 0
+    deleted_ids = []
+    with database.transaction() as conn:
+        for chunk in _chunked(note_ids, chunk_size):
+            cursor = conn.executemany("DELETE FROM notes WHERE id = ?", [(note_id,) for note_id in chunk])
+            deleted += cursor.rowcount
+            search.index_note_terms(conn, [(note_id, None) for note_id in chunk], master_key)
+            deleted_ids.extend(chunk)
+    for note_id in deleted_ids:
+        title_cache.invalidate(note_id)
+        search.unindex_note(note_id)
+    print(f"{deleted} note(s) deleted.")
+    return deleted
+
+
+def _format_datetime(value) -> str:
+    """
+    Format a datetime (or pass through a string) the way notes store timestamps.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def _build_note_filters(filters: dict):
+    """
+    Translate a list_notes filter dict into SQL conditions and parameters.
+    Every condition is served by an index created in initialize_database.
+    """
+    conditions = []
+    params = []
+    if not filters:
+        return conditions, params
+
+    if filters.get("expires_before") is not None:
+        conditions.append(EXPIRED_SQL)
+        params.append(normalize_expires_at(filters["expires_before"]))
+    if filters.get("has_max_opens") is not None:
+        conditions.append("max_opens IS NOT NULL" if filters["has_max_opens"] else "max_opens IS NULL")
+    if filters.get("blind_mode") is not None:
+        conditions.append("blind_mode = ?")
+        params.append(1 if filters["blind_mode"] else 0)
+    if filters.get("is_reflection") is not None:
+        conditions.append("is_reflection = ?")
+        params.append(1 if filters["is_reflection"] else 0)
+    return conditions, params
+
+
+def list_notes(master_key: bytes, page_size: int = None, cursor: tuple = None,
+               filters: dict = None):
+    """
+    List live notes newest first, decrypting only the title for display in a list.
+    Only the notes table is read: contents stay on disk until read_note.
+    Expired and exhausted notes are never returned.
     
     :param master_key: The Fernet key (bytes) used for decryption.
+    :param page_size: Optional maximum number of notes to return; None returns all.
+    :param cursor: Optional (created_at, id) of the last note of the previous page,
+        as returned by next_page_cursor().
+    :param filters: Optional dict with any of:
+        expires_before (datetime or str), has_max_opens (bool),
+        blind_mode (bool), is_reflection (bool).
     :return: A list of dicts, each with keys:
         id, title (decrypted), created_at, updated_at, open_count,
         max_opens, expires_at, is_reflection (bool), blind_mode (bool).
     """
-    conn = database.create_connection()
+    conditions, params = _build_note_filters(filters)
+    # Never return notes that are already dead; the sweeper purges them
+    conditions.append(NOT_EXPIRED_SQL)
+    params.append(_format_datetime(datetime.now()))
+    conditions.append("(max_opens IS NULL OR open_count < max_opens)")
+    if cursor is not None:
+        # Keyset pagination on (created_at, id), matching idx_notes_created
+        conditions.append("(created_at, id) < (?, ?)")
+        params.extend(cursor)
+
+    query = """
+        SELECT id, title, key_id, wrapped_key, created_at, updated_at, open_count, max_opens, expires_at, is_reflection, blind_mode
+        FROM notes
+    """
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY created_at DESC, id DESC"
+    if page_size is not None:
+        query += " LIMIT ?"
+        params.append(page_size)
+
+    conn = database.get_connection()
     if conn is None:
         raise RuntimeError("Cannot connect to database to list notes.")
-    cursor = conn.cursor()
+    db_cursor = conn.cursor()
     try:
-        cursor.execute("""
-            SELECT id, title, created_at, updated_at, open_count, max_opens, expires_at, is_reflection, blind_mode
-            FROM notes
-            ORDER BY created_at DESC
-        """)
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            note_row = dict(row)
-            try:
-                decrypted_title = decrypt_string(note_row["title"], master_key)
-            except Exception:
-                decrypted_title = "<Decryption Error>"
-            item = {
-                "id": note_row["id"],
-                "title": decrypted_title,
-                "created_at": note_row.get("created_at"),
-                "updated_at": note_row.get("updated_at"),
-                "open_count": note_row.get("open_count"),
-                "max_opens": note_row.get("max_opens"),
-                "expires_at": note_row.get("expires_at"),
-                "is_reflection": bool(note_row.get("is_reflection")),
-                "blind_mode": bool(note_row.get("blind_mode"))
-            }
-            result.append(item)
-        return result
+        db_cursor.execute(query, params)
+        return _note_items([dict(row) for row in db_cursor.fetchall()], master_key)
     finally:
-        cursor.close()
-        conn.close()
+        db_cursor.close()
+
+
+def _note_items(rows: list, master_key: bytes) -> list:
+    """
+    Turn note rows (metadata only) into list_notes items, decrypting only the
+    titles the session cache doesn't already hold.
+    """
+    titles = [title_cache.get(row["id"], row["title"]) for row in rows]
+    misses = [i for i, title in enumerate(titles) if title is None]
+    decrypted = decrypt_strings_keyed((rows[i]["title"] for i in misses),
+                                      [rows[i]["key_id"] for i in misses], master_key,
+                                      wrapped_keys=[rows[i]["wrapped_key"] for i in misses])
+    for i, title in zip(misses, decrypted):
+        if title is None:
+            titles[i] = "<Decryption Error>"
+        else:
+            titles[i] = title
+            title_cache.put(rows[i]["id"], rows[i]["title"], title)
+
+    result = []
+    for note_row, decrypted_title in zip(rows, titles):
+        item = {
+            "id": note_row["id"],
+            "title": decrypted_title,
+            "created_at": note_row.get("created_at"),
+            "updated_at": note_row.get("updated_at"),
+            "open_count": note_row.get("open_count"),
+            "max_opens": note_row.get("max_opens"),
+            "expires_at": note_row.get("expires_at"),
+            "is_reflection": bool(note_row.get("is_reflection")),
+            "blind_mode": bool(note_row.get("blind_mode"))
+        }
+        result.append(item)
+    return result
+
+
+def current_revision() -> int:
+    """
+    Return the vault's change-feed revision. Take it before a full list_notes
+    and pass it to changes_since afterwards to receive only what changed.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to read the revision.")
+    return conn.execute("SELECT revision FROM note_revision WHERE id = 1").fetchone()[0]
+
+
+def changes_since(revision: int, master_key: bytes) -> dict:
+    """
+    Return the notes added, changed or removed after `revision`, by this
+    process or any other one using the same vault file. Every write to a note
+    stamps it with the next vault-wide revision and deletes leave a tombstone,
+    so only the rows that changed are read and only their titles decrypted.
+    
+    :param revision: The revision the caller is up to date with.
+    :param master_key: The Fernet key (bytes) used for decryption.
+    :return: A dict with keys:
+        revision (the new revision to pass next time),
+        changed (list_notes items of live notes written since),
+        deleted (IDs of notes deleted, expired or exhausted since),
+        reset (True if tombstones the caller needs were pruned: reload everything).
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to read changes.")
+    state = conn.execute("SELECT revision, pruned_revision FROM note_revision WHERE id = 1").fetchone()
+    if state["revision"] == revision:
+        return {"revision": revision, "changed": [], "deleted": [], "reset": False}
+
+    # The reads below are separate snapshots: bound them by the revision read
+    # above, so anything committed meanwhile is left whole for the next call
+    new_revision = state["revision"]
+    # Liveness is decided by the same SQL test as list_notes and read_note
+    rows = [dict(row) for row in conn.execute(f"""
+        SELECT id, title, key_id, wrapped_key, created_at, updated_at, open_count, max_opens,
+               expires_at, is_reflection, blind_mode, revision,
+               {NOT_EXPIRED_SQL} AND (max_opens IS NULL OR open_count < max_opens) AS live
+        FROM notes WHERE revision > ? AND revision <= ?
+    """, (_format_datetime(datetime.now()), revision, new_revision))]
+    tombstones = conn.execute(
+        "SELECT note_id, revision FROM deleted_notes WHERE revision > ? AND revision <= ?",
+        (revision, new_revision)
+    ).fetchall()
+
+    # Notes that expired or ran out of opens count as removed, as in list_notes
+    live = [row for row in rows if row["live"]]
+    deleted = [row["note_id"] for row in tombstones]
+    deleted.extend(row["id"] for row in rows if not row["live"])
+    return {
+        "revision": new_revision,
+        "changed": _note_items(live, master_key),
+        "deleted": deleted,
+        "reset": revision < state["pruned_revision"]
+    }
+
+
+def prune_change_log(max_age_seconds: int = None) -> int:
+    """
+    Delete tombstones older than `max_age_seconds` (config.CHANGE_LOG_RETENTION_SECONDS
+    by default). Clients behind the newest pruned one get reset=True from changes_since.
+    
+    :return: The number of tombstones deleted.
+    """
+    max_age_seconds = max_age_seconds or config.CHANGE_LOG_RETENTION_SECONDS
+    with database.transaction() as conn:
+        rows = conn.execute(
+            "DELETE FROM deleted_notes WHERE deleted_at < datetime('now', ?) RETURNING revision",
+            (f"-{int(max_age_seconds)} seconds",)
+        ).fetchall()
+        if rows:
+            conn.execute(
+                "UPDATE note_revision SET pruned_revision = MAX(pruned_revision, ?) WHERE id = 1",
+                (max(row["revision"] for row in rows),)
+            )
+    return len(rows)
+
+
+def next_page_cursor(page: list, page_size: int):
+    """
+    Return the cursor for the page after `page`, or None if it was the last one.
+    
+    :param page: A list returned by list_notes.
+    :param page_size: The page_size that list_notes was called with.
+    """
+    if not page or len(page) < page_size:
+        return None
+    last = page[-1]
+    return (last["created_at"], last["id"])
+
+
+def backfill_title_index(master_key: bytes) -> int:
+    """
+    Compute the blind index for notes stored before it existed.
+    
+    :param master_key: The Fernet key (bytes) used for decryption.
+    :return: The number of notes updated.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to index notes.")
+    rows = conn.execute(
+        "SELECT id, title, key_id, wrapped_key FROM notes WHERE title_index IS NULL"
+    ).fetchall()
+    if not rows:
+        return 0
+
+    titles = decrypt_strings_keyed((row["title"] for row in rows), [row["key_id"] for row in rows],
+                                   master_key, wrapped_keys=[row["wrapped_key"] for row in rows])
+    index_key = get_index_key(master_key)
+    updates = [(title_blind_index(title, index_key), row["id"])
+               for row, title in zip(rows, titles) if title is not None]
+    with database.transaction():
+        conn.executemany("UPDATE notes SET title_index = ? WHERE id = ?", updates)
+    print(f"Indexed {len(updates)} note title(s).")
+    return len(updates)
+
+
+def find_note_by_title(title: str, master_key: bytes):
+    """
+    Look up a live note ID by its exact plaintext title with one index probe.
+    Expired and exhausted notes not swept yet are ignored, as in list_notes.
+    Notes stored before the blind index existed are only found once
+    backfill_title_index has run (at unlock).
+    
+    :param title: The plaintext title to look for.
+    :param master_key: The Fernet key (bytes) the notes are encrypted with.
+    :return: The note ID, or None if no live note has this title.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to find note.")
+
+    # Every blind index is computed under the index key, which rotations keep
+    row = conn.execute(f"""
+        SELECT id FROM notes
+        WHERE title_index = ?
+          AND {NOT_EXPIRED_SQL}
+          AND (max_opens IS NULL OR open_count < max_opens)
+        ORDER BY id LIMIT 1
+    """, (title_blind_index(title, get_index_key(master_key)), _format_datetime(datetime.now()))).fetchone()
+    return row["id"] if row else None
+
+
+def title_exists(title: str, master_key: bytes) -> bool:
+    """
+    Return True if a note with exactly this plaintext title already exists.
+    """
+    return find_note_by_title(title, master_key) is not None
+
+
+def purge_expired_notes(master_key: bytes, batch_size: int = None) -> int:
+    """
+    Delete every expired or exhausted note, in batches of `batch_size` rows
+    per transaction so a large purge never holds the write lock for long.
+    Each batch is removed from the search index in its own transaction.
+    
+    :param master_key: The Fernet key (bytes); the persistent search index needs it.
+    :param batch_size: Rows per DELETE; defaults to config.SWEEP_BATCH_SIZE.
+    :return: The number of notes purged.
+    """
+    batch_size = batch_size or config.SWEEP_BATCH_SIZE
+    now_str = _format_datetime(datetime.now())
+    purged = 0
+    while True:
+        with database.transaction() as conn:
+            rows = conn.execute(f"""
+                DELETE FROM notes
+                WHERE id IN (
+                    SELECT id FROM notes WHERE {EXPIRED_SQL}
+                    UNION
+                    SELECT id FROM notes WHERE max_opens IS NOT NULL AND open_count >= max_opens
+                    LIMIT ?
+                )
+                RETURNING id
+            """, (now_str, batch_size)).fetchall()
+            if rows:
+                search.index_note_terms(conn, [(row["id"], None) for row in rows], master_key)
+        for row in rows:
+            title_cache.invalidate(row["id"])
+            search.unindex_note(row["id"])
+        purged += len(rows)
+        if len(rows) < batch_size:
+            break
+    if purged:
+        print(f"🧹 Purged {purged} expired note(s).")
+    return purged
+
+
+_sweeper_thread = None
+_sweeper_stop = threading.Event()
+
+
+def _sweep_loop(interval: float, master_key: bytes):
+    while True:
+        try:
+            purge_expired_notes(master_key)
+            prune_change_log()
+        except Exception as e:
+            print(f"⚠️ Expiry sweep failed: {e}")
+        if _sweeper_stop.wait(interval):
+            break
+    database.close_connection()
+
+
+def start_expiry_sweeper(master_key: bytes, interval: float = None):
+    """
+    Start a daemon thread that purges expired notes (and old change-feed
+    tombstones) right away and then every `interval` seconds
+    (config.SWEEP_INTERVAL_SECONDS by default). `master_key` is needed to
+    remove purged notes from the search index (see purge_expired_notes).
+    Does nothing if the sweeper is already running.
+    """
+    global _sweeper_thread
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return
+    _sweeper_stop.clear()
+    _sweeper_thread = threading.Thread(
+        target=_sweep_loop,
+        args=(interval or config.SWEEP_INTERVAL_SECONDS, master_key),
+        name="expiry-sweeper",
+        daemon=True
+    )
+    _sweeper_thread.start()
+
+
+def stop_expiry_sweeper():
+    """
+    Stop the expiry sweeper thread and wait for it to finish.
+    """
+    global _sweeper_thread
+    if _sweeper_thread is None:
+        return
+    _sweeper_stop.set()
+    _sweeper_thread.join()
+    _sweeper_thread = None
+
+
+def upgrade_ciphertext_format(batch_size: int = None) -> int:
+    """
+    Rewrite notes still stored as base64 Fernet tokens into binary envelopes.
+    No key is needed: the envelope holds the same bytes without the base64.
+    Runs in batches of `batch_size` rows per transaction.
+    
+    :param batch_size: Rows per transaction; defaults to config.BATCH_CHUNK_SIZE.
+    :return: The number of values (titles and contents) rewritten.
+    """
+    batch_size = batch_size or config.BATCH_CHUNK_SIZE
+    marker = LEGACY_TOKEN_PREFIX.hex().upper()
+    upgraded = 0
+    # Streamed contents were never Fernet tokens: skip them without loading their blobs
+    sources = (("notes", "id", "title", "1"),
+               ("note_contents", "note_id", "content", "streamed = 0"))
+    for table, id_column, column, condition in sources:
+        while True:
+            with database.transaction() as conn:
+                rows = conn.execute(f"""
+                    SELECT {id_column}, {column} FROM {table}
+                    WHERE {condition} AND hex(substr({column}, 1, 1)) = ?
+                    LIMIT ?
+                """, (marker, batch_size)).fetchall()
+                conn.executemany(
+                    f"UPDATE {table} SET {column} = ? WHERE {id_column} = ?",
+                    [(to_envelope(row[column]), row[id_column]) for row in rows]
+                )
+            upgraded += len(rows)
+            if len(rows) < batch_size:
+                break
+    if upgraded:
+        print(f"Upgraded {upgraded} note value(s) to the binary ciphertext format.")
+    return upgraded
+
+
+def add_attachment(note_id: int, path: str, master_key: bytes, name: str = None):
+    """
+    Attach a file to a note. The file is encrypted segment by segment straight
+    into the attachment's blob, so memory use does not depend on its size.
+    
+    :param note_id: ID of the note to attach the file to.
+    :param path: Path of the file to attach.
+    :param master_key: The Fernet key (bytes) used for encryption.
+    :param name: Optional display name; defaults to the file's base name.
+    :return: The new attachment's ID, or None if the note does not exist.
+    """
+    size = os.path.getsize(path)
+    blob_size = stream_ciphertext_size(size)
+    data_key, wrapped_key, key_id = new_data_key(master_key)
+    encrypted_name = encrypt_string(name or os.path.basename(path), data_key)
+
+    with database.transaction(immediate=True) as conn:
+        if blob_size > conn.getlimit(sqlite3.SQLITE_LIMIT_LENGTH):
+            raise ValueError(f"Attachment too large: {size} bytes.")
+        if conn.execute("SELECT 1 FROM notes WHERE id = ?", (note_id,)).fetchone() is None:
+            print(f"Note {note_id} not found.")
+            return None
+        attachment_id = conn.execute(
+            "INSERT INTO attachments (note_id, name, size, content, wrapped_key, key_id) "
+            "VALUES (?, ?, ?, zeroblob(?), ?, ?)",
+            (note_id, encrypted_name, size, blob_size, wrapped_key, key_id)
+        ).lastrowid
+        check_current_key(conn, key_id)
+        with open(path, "rb") as f, conn.blobopen("attachments", "content", attachment_id) as blob:
+            written = encrypt_stream(f, blob, data_key)
+        if written != size:
+            raise RuntimeError(f"{path} changed while it was being attached.")
+    print(f"📎 Attachment added to note {note_id}.")
+    return attachment_id
+
+
+def list_attachments(note_id: int, master_key: bytes):
+    """
+    List a note's attachments without reading their contents.
+    
+    :param note_id: ID of the note.
+    :param master_key: The Fernet key (bytes) used for decryption.
+    :return: A list of dicts with keys id, name (decrypted), size, created_at.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to list attachments.")
+    rows = conn.execute(
+        "SELECT id, name, size, created_at, key_id, wrapped_key FROM attachments WHERE note_id = ? ORDER BY id",
+        (note_id,)
+    ).fetchall()
+    names = decrypt_strings_keyed((row["name"] for row in rows), [row["key_id"] for row in rows],
+                                  master_key, default="<Decryption Error>",
+                                  wrapped_keys=[row["wrapped_key"] for row in rows])
+    return [
+        {"id": row["id"], "name": name, "size": row["size"], "created_at": row["created_at"]}
+        for row, name in zip(rows, names)
+    ]
+
+
+def save_attachment(attachment_id: int, dest_path: str, master_key: bytes):
+    """
+    Decrypt an attachment to a file, one segment at a time.
+    The file is written under a temporary name and renamed once fully verified.
+    
+    :param attachment_id: ID of the attachment.
+    :param dest_path: Where to write the decrypted file.
+    :param master_key: The Fernet key (bytes) used for decryption.
+    :return: The number of bytes written, or None if the attachment was not found
+        or could not be decrypted.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to read attachment.")
+    if conn.execute("SELECT 1 FROM attachments WHERE id = ?", (attachment_id,)).fetchone() is None:
+        return None
+
+    tmp_path = dest_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f, \
+                conn.blobopen("attachments", "content", attachment_id, readonly=True) as blob:
+            # Read while the blob is open so the keys come from the same snapshot
+            key_id, wrapped_key = conn.execute(
+                "SELECT key_id, wrapped_key FROM attachments WHERE id = ?", (attachment_id,)
+            ).fetchone()
+            written = decrypt_stream(blob, f, row_cipher(key_id, wrapped_key, master_key))
+        os.replace(tmp_path, dest_path)
+        return written
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"Error reading attachment {attachment_id}: {e}")
+        return None
+
+
+def delete_attachment(attachment_id: int):
+    """
+    Delete an attachment by ID.
+    
+    :param attachment_id: ID of the attachment to delete.
+    """
+    with database.transaction() as conn:
+        conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+    print(f"Attachment {attachment_id} deleted.")
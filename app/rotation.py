@@ -0,0 +1,284 @@
+import threading
+import config
+from database import database
+from app.logic import (
+    get_keyring,
+    clear_keyring_cache,
+    check_current_key,
+    new_data_key,
+    rewrap_data_key,
+    row_cipher,
+    decrypt_strings_keyed,
+    encrypt_strings_with_keys,
+    reencrypt_stream_in_place,
+    title_blind_index,
+    title_cache,
+    InvalidToken
+)
+
+
+def rotation_pending() -> bool:
+    """
+    True while a rotation has not finished (older master keys are still stored,
+    or rows are still under an older key) or some notes or attachments have no
+    data key yet.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        return False
+    return conn.execute("""
+        SELECT EXISTS (SELECT 1 FROM encryption_keys WHERE id < (SELECT key_id FROM auth LIMIT 1))
+            OR EXISTS (SELECT 1 FROM notes WHERE key_id < (SELECT key_id FROM auth LIMIT 1))
+            OR EXISTS (SELECT 1 FROM attachments WHERE key_id < (SELECT key_id FROM auth LIMIT 1))
+            OR EXISTS (SELECT 1 FROM notes WHERE wrapped_key IS NULL)
+            OR EXISTS (SELECT 1 FROM attachments WHERE wrapped_key IS NULL)
+    """).fetchone()[0] == 1
+
+
+def _rewrap_rows(conn, table: str, rows, keyring) -> int:
+    """
+    Move the data keys of rows under an older master key to the current one.
+    Only the wrapped keys change; the UPDATE skips rows rewritten meanwhile.
+    """
+    updates = []
+    for row in rows:
+        try:
+            wrapped_key = rewrap_data_key(row["wrapped_key"], keyring.key(row["key_id"]), keyring.current_key)
+        except InvalidToken:
+            print(f"⚠️ {table} row {row['id']}: data key could not be unwrapped.")
+            continue
+        updates.append((wrapped_key, keyring.current_id, row["id"], row["key_id"], row["wrapped_key"]))
+    if not updates:
+        return 0
+    with database.transaction(immediate=True):
+        check_current_key(conn, keyring.current_id)
+        return conn.executemany(
+            f"UPDATE {table} SET wrapped_key = ?, key_id = ? WHERE id = ? AND key_id = ? AND wrapped_key = ?",
+            updates
+        ).rowcount
+
+
+def _convert_note_chunk(conn, rows, master_key: bytes) -> int:
+    """
+    Give notes written before data keys existed a data key of their own, which
+    means re-encrypting them once. All crypto runs on the crypto thread pool
+    before the write lock is taken; the UPDATEs only apply to rows that still
+    have no data key, so notes edited in the meantime are left alone.
+    """
+    titles = decrypt_strings_keyed((row["title"] for row in rows), [row["key_id"] for row in rows], master_key)
+    small = [i for i, row in enumerate(rows) if not row["streamed"] and row["content"] is not None]
+    contents = dict(zip(small, decrypt_strings_keyed(
+        (rows[i]["content"] for i in small), [rows[i]["key_id"] for i in small], master_key
+    )))
+    readable = [i for i, title in enumerate(titles)
+                if title is not None and (i not in contents or contents[i] is not None)]
+    if not readable:
+        return 0
+    data_keys = {i: new_data_key(master_key) for i in readable}
+    with_content = [i for i in readable if i in contents]
+    encrypted = encrypt_strings_with_keys(
+        [titles[i] for i in readable] + [contents[i] for i in with_content],
+        [data_keys[i][0] for i in readable] + [data_keys[i][0] for i in with_content]
+    )
+    encrypted_titles = dict(zip(readable, encrypted))
+    encrypted_contents = dict(zip(with_content, encrypted[len(readable):]))
+    index_key = get_keyring(master_key).index_key
+
+    converted = 0
+    with database.transaction(immediate=True):
+        check_current_key(conn, data_keys[readable[0]][2])
+        for i in readable:
+            row = rows[i]
+            data_key, wrapped_key, key_id = data_keys[i]
+            # A damaged streamed segment must not leave the note half re-encrypted
+            conn.execute("SAVEPOINT convert_note")
+            if not conn.execute("""
+                UPDATE notes SET title = ?, title_index = ?, wrapped_key = ?, key_id = ?
+                WHERE id = ? AND key_id = ? AND wrapped_key IS NULL
+            """, (encrypted_titles[i], title_blind_index(titles[i], index_key),
+                  wrapped_key, key_id, row["id"], row["key_id"])).rowcount:
+                conn.execute("RELEASE convert_note")
+                continue
+            if row["streamed"]:
+                try:
+                    with conn.blobopen("note_contents", "content", row["id"]) as blob:
+                        reencrypt_stream_in_place(blob, row_cipher(row["key_id"], None, master_key), data_key)
+                except InvalidToken:
+                    conn.execute("ROLLBACK TO convert_note")
+                    conn.execute("RELEASE convert_note")
+                    print(f"⚠️ Note {row['id']} could not be re-encrypted.")
+                    continue
+            elif i in encrypted_contents:
+                conn.execute("UPDATE note_contents SET content = ? WHERE note_id = ?",
+                             (encrypted_contents[i], row["id"]))
+            conn.execute("RELEASE convert_note")
+            converted += 1
+    for i in readable:
+        title_cache.put(rows[i]["id"], encrypted_titles[i], titles[i])
+    return converted
+
+
+def _convert_attachment(conn, row, master_key: bytes) -> bool:
+    """
+    Give an attachment written before data keys existed a data key of its own,
+    re-encrypting its name and blob in one transaction.
+    """
+    name = decrypt_strings_keyed([row["name"]], [row["key_id"]], master_key)[0]
+    if name is None:
+        return False
+    data_key, wrapped_key, key_id = new_data_key(master_key)
+    encrypted_name = encrypt_strings_with_keys([name], [data_key])[0]
+    try:
+        with database.transaction(immediate=True):
+            check_current_key(conn, key_id)
+            if not conn.execute("""
+                UPDATE attachments SET name = ?, wrapped_key = ?, key_id = ?
+                WHERE id = ? AND key_id = ? AND wrapped_key IS NULL
+            """, (encrypted_name, wrapped_key, key_id, row["id"], row["key_id"])).rowcount:
+                return False
+            with conn.blobopen("attachments", "content", row["id"]) as blob:
+                reencrypt_stream_in_place(blob, row_cipher(row["key_id"], None, master_key), data_key)
+    except InvalidToken:
+        print(f"⚠️ Attachment {row['id']} could not be re-encrypted.")
+        return False
+    return True
+
+
+def run_key_rotation(master_key: bytes, chunk_size: int = None, progress=None, stop_event=None) -> int:
+    """
+    Finish a master-key rotation (see auth.rotate_master_key) and give data keys
+    to rows written before they existed:
+    1. Rewrap the data keys still under an older master key; only the 40-byte
+       wrapped keys are rewritten, never the note bodies.
+    2. Re-encrypt notes and attachments without a data key under a fresh one.
+    Rows go `chunk_size` per transaction (attachments without a data key one
+    per transaction); each committed chunk is a checkpoint, since a row's
+    key_id / wrapped_key tell whether it was done, so after a crash or a stop
+    the job picks up where it left off. Once no row needs an older key, those
+    keys are deleted.
+
+    :param master_key: The current master key.
+    :param chunk_size: Rows per transaction; defaults to config.ROTATION_CHUNK_SIZE.
+    :param progress: Optional callable(rotated_count) called after each chunk.
+    :param stop_event: Optional threading.Event that stops the job between chunks.
+    :return: The number of notes and attachments rewrapped or re-encrypted.
+    """
+    chunk_size = chunk_size or config.ROTATION_CHUNK_SIZE
+    keyring = get_keyring(master_key)
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to rotate keys.")
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    rotated = 0
+    for table in ("notes", "attachments"):
+        last_id = 0
+        while not stopped():
+            rows = conn.execute(f"""
+                SELECT id, key_id, wrapped_key FROM {table}
+                WHERE key_id < ? AND wrapped_key IS NOT NULL AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (keyring.current_id, last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            rotated += _rewrap_rows(conn, table, rows, keyring)
+            last_id = rows[-1]["id"]
+            if progress is not None:
+                progress(rotated)
+
+    last_id = 0
+    while not stopped():
+        rows = conn.execute("""
+            SELECT n.id, n.title, n.key_id, c.streamed,
+                   CASE WHEN c.streamed THEN NULL ELSE c.content END AS content
+            FROM notes n LEFT JOIN note_contents c ON c.note_id = n.id
+            WHERE n.wrapped_key IS NULL AND n.id > ?
+            ORDER BY n.id
+            LIMIT ?
+        """, (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        rotated += _convert_note_chunk(conn, rows, master_key)
+        last_id = rows[-1]["id"]
+        if progress is not None:
+            progress(rotated)
+
+    last_id = 0
+    while not stopped():
+        row = conn.execute(
+            "SELECT id, name, key_id FROM attachments WHERE wrapped_key IS NULL AND id > ? ORDER BY id LIMIT 1",
+            (last_id,)
+        ).fetchone()
+        if row is None:
+            break
+        rotated += _convert_attachment(conn, row, master_key)
+        last_id = row["id"]
+        if progress is not None:
+            progress(rotated)
+
+    if stopped():
+        return rotated
+    # Writers check the key ID under the write lock (check_current_key), so once
+    # none is left here no row can be written under an older key any more
+    with database.transaction(immediate=True):
+        check_current_key(conn, keyring.current_id)
+        remaining = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM notes WHERE key_id < ?)
+                 + (SELECT COUNT(*) FROM attachments WHERE key_id < ?)
+        """, (keyring.current_id, keyring.current_id)).fetchone()[0]
+        if not remaining:
+            conn.execute("DELETE FROM encryption_keys WHERE id < ?", (keyring.current_id,))
+    if remaining:
+        print(f"⚠️ Key rotation: {remaining} item(s) could not be re-encrypted; older keys kept.")
+    else:
+        clear_keyring_cache()
+        print(f"🔁 Key rotation finished ({rotated} item(s) updated).")
+    return rotated
+
+
+_rotation_thread = None
+_rotation_stop = threading.Event()
+
+
+def _rotation_loop(master_key: bytes, chunk_size: int):
+    try:
+        run_key_rotation(master_key, chunk_size, stop_event=_rotation_stop)
+    except Exception as e:
+        print(f"⚠️ Key rotation failed: {e}")
+    finally:
+        database.close_connection()
+
+
+def start_key_rotation(master_key: bytes, chunk_size: int = None):
+    """
+    Run run_key_rotation on a daemon thread if a rotation is pending.
+    Does nothing if it is already running.
+    """
+    global _rotation_thread
+    if _rotation_thread is not None and _rotation_thread.is_alive():
+        return
+    if not rotation_pending():
+        return
+    _rotation_stop.clear()
+    _rotation_thread = threading.Thread(
+        target=_rotation_loop,
+        args=(master_key, chunk_size or config.ROTATION_CHUNK_SIZE),
+        name="key-rotation",
+        daemon=True
+    )
+    _rotation_thread.start()
+
+
+def stop_key_rotation():
+    """
+    Stop the rotation thread after its current chunk and wait for it.
+    """
+    global _rotation_thread
+    if _rotation_thread is None:
+        return
+    _rotation_stop.set()
+    _rotation_thread.join()
+    _rotation_thread = None
@@ -0,0 +1,602 @@
+import io
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import hmac
+import hashlib
+import config
+from collections import defaultdict
+from datetime import datetime
+from cryptography.exceptions import InvalidTag
+from database import database
+from app.logic import (
+    decrypt_strings_keyed,
+    decrypt_stream,
+    search_index_keys,
+    get_index_key,
+    row_cipher,
+    title_cache,
+    NOT_EXPIRED_SQL
+)
+
+_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# Persistent index: bytes kept from each HMAC token, and AES-GCM nonce size
+TOKEN_SIZE = 16
+_NONCE_SIZE = 12
+
+
+class SearchIndex:
+    """
+    Full-text index of decrypted titles and contents for the unlocked session.
+
+    It lives in a private `:memory:` SQLite database (FTS5, temp_store in memory),
+    so no plaintext ever reaches the disk, and disappears when closed.
+    The FTS rowid is the note ID. All access goes through one lock, so the index
+    can be updated from any thread.
+    """
+
+    def __init__(self):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA temp_store = MEMORY")
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE note_fts USING fts5(
+                title, content,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        """)
+        self._lock = threading.Lock()
+        self._closed = False
+        # IDs written by put/delete while the initial build runs: the build must not overwrite them
+        self._touched = set()
+        self._building = False
+        # True once the initial build has finished
+        self.ready = False
+
+    def put(self, note_id: int, title: str, content: str):
+        with self._lock:
+            if self._closed:
+                return
+            self._put(note_id, title, content)
+            self._conn.commit()
+            if self._building:
+                self._touched.add(note_id)
+
+    def put_many(self, items):
+        """Index many (note_id, title, content) tuples in one transaction."""
+        with self._lock:
+            if self._closed:
+                return
+            for note_id, title, content in items:
+                self._put(note_id, title, content)
+                if self._building:
+                    self._touched.add(note_id)
+            self._conn.commit()
+
+    def delete(self, note_id: int):
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.execute("DELETE FROM note_fts WHERE rowid = ?", (note_id,))
+            self._conn.commit()
+            if self._building:
+                self._touched.add(note_id)
+
+    def search(self, query: str, limit: int = 50) -> list:
+        """
+        Return the best matches for `query`, best first. Every word of the query
+        must match the start of a word in the title or content.
+        """
+        match = _match_expression(query)
+        if not match:
+            return []
+        with self._lock:
+            if self._closed:
+                return []
+            rows = self._conn.execute("""
+                SELECT rowid, title, snippet(note_fts, 1, '[', ']', '…', 12)
+                FROM note_fts
+                WHERE note_fts MATCH ?
+                ORDER BY bm25(note_fts, 10.0, 1.0)
+                LIMIT ?
+            """, (match, limit)).fetchall()
+        return [{"id": row[0], "title": row[1], "snippet": row[2]} for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            if self._closed:
+                return 0
+            return self._conn.execute("SELECT COUNT(*) FROM note_fts").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._conn.close()
+
+    def _put(self, note_id, title, content):
+        self._conn.execute("DELETE FROM note_fts WHERE rowid = ?", (note_id,))
+        self._conn.execute("INSERT INTO note_fts (rowid, title, content) VALUES (?, ?, ?)",
+                           (note_id, title, content or ""))
+
+    def _begin_build(self):
+        with self._lock:
+            self._building = True
+            self._touched.clear()
+
+    def _add_built(self, items):
+        """Insert notes read by the initial build, skipping any changed meanwhile."""
+        with self._lock:
+            if self._closed:
+                return
+            for note_id, title, content in items:
+                if note_id not in self._touched:
+                    self._put(note_id, title, content)
+            self._conn.commit()
+
+    def _end_build(self):
+        with self._lock:
+            self._building = False
+            self._touched.clear()
+
+
+def _match_expression(query: str) -> str:
+    """
+    Turn free text into an FTS5 expression: each word becomes a quoted prefix term,
+    so user input can never be parsed as FTS5 syntax.
+    """
+    return " ".join(f'"{term}"*' for term in _TERM_PATTERN.findall(query))
+
+
+_index = None
+_build_thread = None
+_build_stop = threading.Event()
+_index_lock = threading.Lock()
+
+
+def _read_streamed(conn, note_id: int, key_id: int, wrapped_key: bytes, master_key: bytes):
+    plaintext = io.BytesIO()
+    try:
+        key = row_cipher(key_id, wrapped_key, master_key)
+        with conn.blobopen("note_contents", "content", note_id, readonly=True) as blob:
+            decrypt_stream(blob, plaintext, key)
+        return plaintext.getvalue().decode()
+    except Exception:
+        return None
+
+
+def _build_index(conn, index: SearchIndex, master_key: bytes, batch_size: int):
+    index._begin_build()
+    try:
+        last_id = 0
+        while not _build_stop.is_set():
+            rows = conn.execute("""
+                SELECT n.id, n.title, n.key_id, n.wrapped_key, c.streamed,
+                       CASE WHEN c.streamed THEN NULL ELSE c.content END AS content
+                FROM notes n LEFT JOIN note_contents c ON c.note_id = n.id
+                WHERE n.id > ?
+                ORDER BY n.id
+                LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            decrypted = decrypt_strings_keyed(
+                [row["title"] for row in rows] + [row["content"] or b"" for row in rows],
+                [row["key_id"] for row in rows] * 2,
+                master_key,
+                wrapped_keys=[row["wrapped_key"] for row in rows] * 2
+            )
+            titles, contents = decrypted[:len(rows)], decrypted[len(rows):]
+            items = []
+            for row, title, content in zip(rows, titles, contents):
+                if row["streamed"]:
+                    content = _read_streamed(conn, row["id"], row["key_id"], row["wrapped_key"], master_key)
+                if title is not None:
+                    items.append((row["id"], title, content))
+            index._add_built(items)
+            last_id = rows[-1]["id"]
+        if not _build_stop.is_set():
+            index.ready = True
+            print(f"🔎 Search index ready ({len(index)} note(s)).")
+    finally:
+        index._end_build()
+
+
+def _background_indexing(index, master_key: bytes, batch_size: int):
+    """
+    Bring the persistent index up to date, then fill the in-memory index.
+    """
+    try:
+        conn = database.get_connection()
+        if conn is None:
+            raise RuntimeError("Cannot connect to database to build the search index.")
+        if config.SEARCH_PERSISTENT_INDEX_ENABLED:
+            sync_persistent_index(master_key, batch_size, _build_stop)
+        if index is not None and not _build_stop.is_set():
+            _build_index(conn, index, master_key, batch_size)
+    except Exception as e:
+        print(f"⚠️ Building the search index failed: {e}")
+    finally:
+        database.close_connection()
+
+
+def start_search_index(master_key: bytes, batch_size: int = None):
+    """
+    Prepare search for the unlocked vault on a background thread: catch the
+    persistent index up with changes it missed, then create the in-memory index
+    (unless config.SEARCH_INDEX_ENABLED is off) and fill it from the notes table.
+    Notes written through app.notes meanwhile are indexed right away.
+    Does nothing if search is already running.
+    """
+    global _index, _build_thread
+    if not (config.SEARCH_INDEX_ENABLED or config.SEARCH_PERSISTENT_INDEX_ENABLED):
+        return
+    with _index_lock:
+        if _build_thread is not None:
+            return
+        _index = None
+        if config.SEARCH_INDEX_ENABLED:
+            try:
+                _index = SearchIndex()
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5: the persistent index answers every search
+                print(f"⚠️ In-memory search index unavailable ({e}); using the persistent index.")
+        _build_stop.clear()
+        _build_thread = threading.Thread(
+            target=_background_indexing,
+            args=(_index, master_key, batch_size or config.SEARCH_INDEX_BATCH_SIZE),
+            name="search-index",
+            daemon=True
+        )
+        _build_thread.start()
+
+
+def stop_search_index():
+    """
+    Stop any build in progress and destroy the index with all the plaintext it holds
+    (call on lock).
+    """
+    global _index, _build_thread
+    with _index_lock:
+        index, thread = _index, _build_thread
+        _index = None
+        _build_thread = None
+    if thread is not None:
+        _build_stop.set()
+        thread.join()
+    if index is not None:
+        index.close()
+
+
+def index_note(note_id: int, title: str, content: str):
+    """Add or refresh one note in the index, if there is one."""
+    index = _index
+    if index is not None:
+        index.put(note_id, title, content)
+
+
+def index_notes(items):
+    """Add or refresh many (note_id, title, content) tuples, if there is an index."""
+    index = _index
+    if index is not None:
+        index.put_many(items)
+
+
+def unindex_note(note_id: int):
+    """Drop one note from the index, if there is one."""
+    index = _index
+    if index is not None:
+        index.delete(note_id)
+
+
+def search_notes(query: str, limit: int = 50, master_key: bytes = None) -> list:
+    """
+    Full-text search over note titles and contents.
+    Once the in-memory index is built, results are ranked and every word matches
+    as a word prefix. Until then (or if it is disabled), and if master_key is given,
+    the persistent index answers instead: whole words only, newest notes first.
+
+    :param query: Free text; every word must match.
+    :param limit: Maximum number of results.
+    :param master_key: The Fernet key (bytes), needed for the persistent index.
+    :return: A list of dicts with keys id, title and snippet (None from the
+        persistent index), or an empty list if the vault is locked.
+    """
+    index = _index
+    if index is not None and index.ready:
+        return _search_live(index, query, limit)
+    if master_key is not None and config.SEARCH_PERSISTENT_INDEX_ENABLED:
+        return search_persistent_index(query, master_key, limit)
+    if index is not None:
+        return _search_live(index, query, limit)
+    return []
+
+
+def _live_notes(conn, note_ids) -> list:
+    """
+    Return the rows (id, title, key_id, wrapped_key, created_at) of the notes
+    among `note_ids` that still exist and are neither expired nor exhausted,
+    with the same test as list_notes.
+    """
+    rows = []
+    now_str = datetime.now().isoformat(sep=' ')
+    note_ids = list(note_ids)
+    for start in range(0, len(note_ids), 500):
+        chunk = note_ids[start:start + 500]
+        rows.extend(conn.execute(f"""
+            SELECT id, title, key_id, wrapped_key, created_at FROM notes
+            WHERE id IN ({",".join("?" * len(chunk))})
+              AND {NOT_EXPIRED_SQL}
+              AND (max_opens IS NULL OR open_count < max_opens)
+        """, (*chunk, now_str)).fetchall())
+    return rows
+
+
+def _search_live(index, query: str, limit: int) -> list:
+    """
+    Search the in-memory index, dropping notes that expired or ran out of opens
+    but have not been swept yet; asks the index for more until `limit` live
+    results are found or it has no more.
+    """
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to search notes.")
+    fetch = limit
+    while True:
+        results = index.search(query, fetch)
+        live = {row["id"] for row in _live_notes(conn, (result["id"] for result in results))}
+        found = [result for result in results if result["id"] in live]
+        if len(found) >= limit or len(results) < fetch:
+            return found[:limit]
+        fetch *= 2
+
+
+# ---------------------------------------------------------------------------
+# Persistent encrypted index
+#
+# search_postings maps (token, bucket) to a sealed posting list: token is the
+# truncated HMAC of a normalized term under a subkey of the master key, so the
+# term dictionary reveals nothing about the words; bucket is note_id //
+# config.SEARCH_POSTING_BUCKET_SIZE, so updating one note rewrites small lists
+# even for very common words. search_note_terms keeps each note's sealed token
+# set, so an update only touches the terms that changed.
+# What leaks is the number of notes per token and bucket, and which rows a
+# write touches.
+# ---------------------------------------------------------------------------
+
+def _normalize_terms(text: str) -> set:
+    """
+    Split text into the set of terms the persistent index stores: casefolded,
+    accents removed (like FTS5's remove_diacritics).
+    """
+    text = text.casefold()
+    if not text.isascii():
+        decomposed = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return set(_TERM_PATTERN.findall(text))
+
+
+def _term_token(token_key: bytes, term: str) -> bytes:
+    return hmac.new(token_key, term.encode("utf-8"), hashlib.sha256).digest()[:TOKEN_SIZE]
+
+
+def _seal(aead, data: bytes, aad: bytes) -> bytes:
+    nonce = os.urandom(_NONCE_SIZE)
+    return nonce + aead.encrypt(nonce, data, aad)
+
+
+def _open(aead, sealed: bytes, aad: bytes) -> bytes:
+    return aead.decrypt(sealed[:_NONCE_SIZE], sealed[_NONCE_SIZE:], aad)
+
+
+def _posting_aad(token: bytes, bucket: int) -> bytes:
+    # Binds a posting list to its row, so lists can't be swapped between terms
+    return b"postings/" + token + bucket.to_bytes(8, "big")
+
+
+def _note_terms_aad(note_id: int) -> bytes:
+    return b"note-terms/" + note_id.to_bytes(8, "big")
+
+
+def _encode_ids(ids) -> bytes:
+    """Sorted IDs as varint-encoded deltas."""
+    out = bytearray()
+    previous = 0
+    for note_id in sorted(ids):
+        delta = note_id - previous
+        previous = note_id
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def _decode_ids(data: bytes) -> set:
+    ids = set()
+    value = shift = previous = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += value
+        ids.add(previous)
+        value = shift = 0
+    return ids
+
+
+def index_note_terms(conn, changes, master_key: bytes, only_missing: bool = False) -> int:
+    """
+    Apply note changes to the persistent index inside the caller's transaction.
+    Each posting list touched by the batch is read, updated and rewritten once.
+
+    :param conn: The connection whose transaction the writes join.
+    :param changes: Iterable of (note_id, text) where text is the note's title and
+        content joined, or None if the note was deleted.
+    :param master_key: The Fernet key (bytes); the index subkeys come from its keyring's index key.
+    :param only_missing: Skip notes that already have an entry (used by the backfill,
+        so it never overwrites a newer entry written meanwhile).
+    :return: The number of notes applied.
+    """
+    if not config.SEARCH_PERSISTENT_INDEX_ENABLED:
+        return 0
+    token_key, aead = search_index_keys(get_index_key(master_key))
+    bucket_size = config.SEARCH_POSTING_BUCKET_SIZE
+    # Terms repeat across the notes of a batch: compute each token once
+    tokens = {}
+    added = defaultdict(set)
+    removed = defaultdict(set)
+    applied = 0
+
+    for note_id, text in changes:
+        row = conn.execute("SELECT tokens FROM search_note_terms WHERE note_id = ?", (note_id,)).fetchone()
+        if row is not None and only_missing:
+            continue
+        old_tokens = set()
+        if row is not None:
+            sealed = _open(aead, row["tokens"], _note_terms_aad(note_id))
+            old_tokens = {sealed[i:i + TOKEN_SIZE] for i in range(0, len(sealed), TOKEN_SIZE)}
+        new_tokens = set()
+        if text is not None:
+            for term in _normalize_terms(text):
+                token = tokens.get(term)
+                if token is None:
+                    token = tokens[term] = _term_token(token_key, term)
+                new_tokens.add(token)
+
+        bucket = note_id // bucket_size
+        for token in new_tokens - old_tokens:
+            added[(token, bucket)].add(note_id)
+        for token in old_tokens - new_tokens:
+            removed[(token, bucket)].add(note_id)
+
+        if text is None:
+            conn.execute("DELETE FROM search_note_terms WHERE note_id = ?", (note_id,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_note_terms (note_id, tokens) VALUES (?, ?)",
+                (note_id, _seal(aead, b"".join(sorted(new_tokens)), _note_terms_aad(note_id)))
+            )
+        applied += 1
+
+    for token, bucket in sorted(added.keys() | removed.keys()):
+        aad = _posting_aad(token, bucket)
+        row = conn.execute(
+            "SELECT postings FROM search_postings WHERE token = ? AND bucket = ?", (token, bucket)
+        ).fetchone()
+        ids = _decode_ids(_open(aead, row["postings"], aad)) if row is not None else set()
+        ids |= added.get((token, bucket), set())
+        ids -= removed.get((token, bucket), set())
+        if ids:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_postings (token, bucket, postings) VALUES (?, ?, ?)",
+                (token, bucket, _seal(aead, _encode_ids(ids), aad))
+            )
+        elif row is not None:
+            conn.execute("DELETE FROM search_postings WHERE token = ? AND bucket = ?", (token, bucket))
+    return applied
+
+
+def sync_persistent_index(master_key: bytes, batch_size: int = None, stop_event=None) -> int:
+    """
+    Catch the persistent index up with changes made without the key: drop entries
+    of notes deleted by the expiry sweeper or delete_note, and index notes written
+    before the index existed. Runs in batches of `batch_size` notes per transaction.
+
+    :return: The number of notes added or removed.
+    """
+    batch_size = batch_size or config.SEARCH_INDEX_BATCH_SIZE
+    synced = 0
+
+    while stop_event is None or not stop_event.is_set():
+        with database.transaction() as conn:
+            rows = conn.execute("""
+                SELECT t.note_id FROM search_note_terms t
+                WHERE NOT EXISTS (SELECT 1 FROM notes n WHERE n.id = t.note_id)
+                LIMIT ?
+            """, (batch_size,)).fetchall()
+            synced += index_note_terms(conn, [(row["note_id"], None) for row in rows], master_key)
+        if len(rows) < batch_size:
+            break
+
+    while stop_event is None or not stop_event.is_set():
+        conn = database.get_connection()
+        rows = conn.execute("""
+            SELECT n.id, n.title, n.key_id, n.wrapped_key, c.streamed,
+                   CASE WHEN c.streamed THEN NULL ELSE c.content END AS content
+            FROM notes n LEFT JOIN note_contents c ON c.note_id = n.id
+            WHERE NOT EXISTS (SELECT 1 FROM search_note_terms t WHERE t.note_id = n.id)
+            ORDER BY n.id
+            LIMIT ?
+        """, (batch_size,)).fetchall()
+        if not rows:
+            break
+        decrypted = decrypt_strings_keyed(
+            [row["title"] for row in rows] + [row["content"] or b"" for row in rows],
+            [row["key_id"] for row in rows] * 2,
+            master_key, default="",
+            wrapped_keys=[row["wrapped_key"] for row in rows] * 2
+        )
+        changes = []
+        for row, title, content in zip(rows, decrypted[:len(rows)], decrypted[len(rows):]):
+            if row["streamed"]:
+                content = _read_streamed(conn, row["id"], row["key_id"], row["wrapped_key"], master_key) or ""
+            changes.append((row["id"], f"{title}\n{content}"))
+        with database.transaction() as conn:
+            synced += index_note_terms(conn, changes, master_key, only_missing=True)
+        if len(rows) < batch_size:
+            break
+
+    if synced:
+        print(f"🔎 Persistent search index updated for {synced} note(s).")
+    return synced
+
+
+def search_persistent_index(query: str, master_key: bytes, limit: int = 50) -> list:
+    """
+    Look up notes containing every word of `query` in the persistent index.
+    Only live notes are returned, newest first.
+
+    :return: A list of dicts with keys id, title and snippet (always None).
+    """
+    terms = _normalize_terms(query)
+    if not terms:
+        return []
+    conn = database.get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to search notes.")
+    token_key, aead = search_index_keys(get_index_key(master_key))
+
+    matches = None
+    for term in terms:
+        token = _term_token(token_key, term)
+        ids = set()
+        for row in conn.execute("SELECT bucket, postings FROM search_postings WHERE token = ?", (token,)):
+            try:
+                ids |= _decode_ids(_open(aead, row["postings"], _posting_aad(token, row["bucket"])))
+            except InvalidTag:
+                continue
+        matches = ids if matches is None else matches & ids
+        if not matches:
+            return []
+
+    # Drop deleted, expired and exhausted notes; keep the newest `limit`
+    rows = _live_notes(conn, matches)
+    rows.sort(key=lambda row: (row["created_at"], row["id"]), reverse=True)
+    rows = rows[:limit]
+
+    titles = [title_cache.get(row["id"], row["title"]) for row in rows]
+    misses = [i for i, title in enumerate(titles) if title is None]
+    decrypted = decrypt_strings_keyed((rows[i]["title"] for i in misses),
+                                      [rows[i]["key_id"] for i in misses], master_key,
+                                      wrapped_keys=[rows[i]["wrapped_key"] for i in misses])
+    for i, title in zip(misses, decrypted):
+        if title is None:
+            titles[i] = "<Decryption Error>"
+        else:
+            titles[i] = title
+            title_cache.put(rows[i]["id"], rows[i]["title"], title)
+    return [{"id": row["id"], "title": title, "snippet": None} for row, title in zip(rows, titles)]
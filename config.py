@@ -4,3 +4,70 @@ load_dotenv()
 
 DB_PATH = os.getenv("DB_PATH", "secure_notes.db")
 APP_NAME = os.getenv("APP_NAME", "Secure Notes")
+
+# Password KDF: "pbkdf2" or "scrypt", calibrated to take about KDF_TARGET_MS per unlock
+KDF_ALGORITHM = os.getenv("KDF_ALGORITHM", "pbkdf2")
+KDF_TARGET_MS = int(os.getenv("KDF_TARGET_MS", "500"))
+
+# Batch encryption/decryption: worker threads (0 = one per CPU), items per task,
+# and the item count below which batches are processed serially
+DECRYPT_WORKERS = int(os.getenv("DECRYPT_WORKERS", "0"))
+DECRYPT_CHUNK_SIZE = int(os.getenv("DECRYPT_CHUNK_SIZE", "128"))
+PARALLEL_DECRYPT_THRESHOLD = int(os.getenv("PARALLEL_DECRYPT_THRESHOLD", "256"))
+
+# Decrypted titles kept in memory while the vault is unlocked
+TITLE_CACHE_SIZE = int(os.getenv("TITLE_CACHE_SIZE", "10000"))
+
+# Background expiry sweeper: seconds between sweeps and rows deleted per transaction
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+
+# Rows per executemany call in the batch note APIs (all chunks share one transaction)
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+
+# SQLite performance profile, applied to every connection
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-65536"))  # negative = KiB, positive = pages
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+# Cipher for newly written notes: "aes-gcm", "chacha20" or "fernet"
+CIPHER_ENGINE = os.getenv("CIPHER_ENGINE", "aes-gcm")
+
+# Compress note plaintext before encryption (AEAD engines only): zlib from
+# COMPRESSION_MIN_SIZE bytes, lzma from LZMA_MIN_SIZE bytes
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "512"))
+LZMA_MIN_SIZE = int(os.getenv("LZMA_MIN_SIZE", str(64 * 1024)))
+
+# Note contents of at least STREAM_THRESHOLD bytes (and all attachments) are
+# encrypted in STREAM_SEGMENT_SIZE segments and streamed into SQLite blobs
+STREAM_THRESHOLD = int(os.getenv("STREAM_THRESHOLD", str(1024 * 1024)))
+STREAM_SEGMENT_SIZE = int(os.getenv("STREAM_SEGMENT_SIZE", str(64 * 1024)))
+
+# In-memory full-text search index, built in the background at unlock
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "1") == "1"
+SEARCH_INDEX_BATCH_SIZE = int(os.getenv("SEARCH_INDEX_BATCH_SIZE", "500"))
+
+# Persistent encrypted search index, updated on every write; posting lists are
+# split into buckets of SEARCH_POSTING_BUCKET_SIZE note IDs
+SEARCH_PERSISTENT_INDEX_ENABLED = os.getenv("SEARCH_PERSISTENT_INDEX_ENABLED", "1") == "1"
+SEARCH_POSTING_BUCKET_SIZE = int(os.getenv("SEARCH_POSTING_BUCKET_SIZE", "1024"))
+
+# Master-key rotation: notes re-encrypted per transaction by the background job
+ROTATION_CHUNK_SIZE = int(os.getenv("ROTATION_CHUNK_SIZE", "500"))
+
+# Unwrapped per-note data keys kept for the unlocked session (0 = unwrap on every use)
+DATA_KEY_CACHE_SIZE = int(os.getenv("DATA_KEY_CACHE_SIZE", "4096"))
+
+# Change feed: how often the GUI polls for notes changed by any process, and
+# how long tombstones of deleted notes are kept for clients that fall behind
+CHANGE_POLL_INTERVAL_MS = int(os.getenv("CHANGE_POLL_INTERVAL_MS", "1000"))
+CHANGE_LOG_RETENTION_SECONDS = int(os.getenv("CHANGE_LOG_RETENTION_SECONDS", str(24 * 3600)))
+
+# Notes per list_notes page when the GUI loads the note list; the first page is
+# shown right away and the rest are fetched in the background
+NOTE_LIST_PAGE_SIZE = int(os.getenv("NOTE_LIST_PAGE_SIZE", "200"))
@@ -1,21 +1,183 @@
 import sqlite3
 import os
+import threading
 import config 
+from contextlib import contextmanager
 from sqlite3 import Error
 
+# Per-thread long-lived connections, reused by every call site.
+_local = threading.local()
+_connections_lock = threading.Lock()
+_open_connections = set()
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+_TEMP_STORES = {"DEFAULT", "FILE", "MEMORY"}
+
+def _apply_pragmas(conn):
+    """
+    Apply the performance profile from config to a new connection.
+    Unknown mode names fall back to SQLite's defaults.
+    """
+    journal_mode = str(getattr(config, "DB_JOURNAL_MODE", "WAL")).upper()
+    synchronous = str(getattr(config, "DB_SYNCHRONOUS", "NORMAL")).upper()
+    temp_store = str(getattr(config, "DB_TEMP_STORE", "MEMORY")).upper()
+
+    if journal_mode in _JOURNAL_MODES:
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    if synchronous in _SYNCHRONOUS_MODES:
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+    if temp_store in _TEMP_STORES:
+        conn.execute(f"PRAGMA temp_store = {temp_store}")
+    conn.execute(f"PRAGMA cache_size = {int(getattr(config, 'DB_CACHE_SIZE', -2000))}")
+    conn.execute(f"PRAGMA mmap_size = {int(getattr(config, 'DB_MMAP_SIZE', 0))}")
+    conn.execute(f"PRAGMA busy_timeout = {int(getattr(config, 'DB_BUSY_TIMEOUT_MS', 5000))}")
+
 def create_connection():
     try:
         db_path = getattr(config, "DB_PATH", "secure_notes.db")
-        conn = sqlite3.connect(db_path)
+        # Connections are owned by one thread; check_same_thread is off only so that
+        # close_all_connections can close them at shutdown.
+        conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            cached_statements=getattr(config, "DB_CACHED_STATEMENTS", 128)
+        )
         conn.row_factory = sqlite3.Row
+        _apply_pragmas(conn)
         print("✅ Connection to SQLite database established.")
         return conn
     except Error as e:
         print(f"❌ Error connecting to SQLite database: {e}")
         return None
 
-def initialize_database():
+def get_connection():
+    """
+    Return the long-lived connection for the current thread, opening it on first use.
+    The connection is reopened if config.DB_PATH changed since it was created.
+    """
+    db_path = getattr(config, "DB_PATH", "secure_notes.db")
+    conn = getattr(_local, "conn", None)
+    if (conn is not None and getattr(_local, "db_path", None) == db_path
+            and conn in _open_connections):
+        return conn
+    if conn is not None:
+        close_connection()
+
     conn = create_connection()
+    if conn is None:
+        return None
+    _local.conn = conn
+    _local.db_path = db_path
+    _local.depth = 0
+    with _connections_lock:
+        _open_connections.add(conn)
+    return conn
+
+@contextmanager
+def transaction(immediate: bool = False):
+    """
+    Run the enclosed block in a transaction on the thread's connection.
+    Commits on success, rolls back on error. Nested blocks join the outer transaction.
+    With immediate=True the write lock is taken up front (BEGIN IMMEDIATE).
+    """
+    conn = get_connection()
+    if conn is None:
+        raise RuntimeError("Cannot connect to database.")
+
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+
+    if immediate and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _local.depth = 0
+
+def close_connection():
+    """
+    Close the current thread's connection, if any.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    with _connections_lock:
+        _open_connections.discard(conn)
+    _local.conn = None
+    _local.db_path = None
+    _local.depth = 0
+    conn.close()
+
+def close_all_connections():
+    """
+    Close every connection handed out by get_connection (e.g. on application exit).
+    """
+    with _connections_lock:
+        conns = list(_open_connections)
+        _open_connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Error:
+            pass
+    _local.conn = None
+    _local.db_path = None
+    _local.depth = 0
+
+def _ensure_column(cursor, table: str, column: str, declaration: str):
+    """
+    Add a column to an existing table if an older database lacks it.
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    if column not in existing:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _split_note_contents(cursor):
+    """
+    Move note bodies out of an older notes table (which kept them in a
+    `content` column) into note_contents, then drop that column.
+    """
+    cursor.execute("PRAGMA table_info(notes)")
+    if "content" not in {row[1] for row in cursor.fetchall()}:
+        return
+    cursor.execute("""
+        INSERT OR REPLACE INTO note_contents (note_id, content)
+        SELECT id, content FROM notes
+    """)
+    cursor.execute("ALTER TABLE notes DROP COLUMN content")
+    print("📦 Note contents moved to the note_contents table.")
+
+# Streamed note bodies and attachments need Connection.blobopen / getlimit
+# (Python 3.11); the schema and queries use RETURNING and DROP COLUMN (SQLite 3.35)
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+def check_runtime():
+    """
+    Raise RuntimeError if this Python or its SQLite library is too old for the vault.
+    """
+    if not hasattr(sqlite3.Connection, "blobopen"):
+        raise RuntimeError("SecureNotes needs Python 3.11 or newer (sqlite3 blob I/O).")
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            f"SecureNotes needs SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer "
+            f"(found {sqlite3.sqlite_version})."
+        )
+
+def initialize_database():
+    check_runtime()
+    conn = get_connection()
     if conn is None:
         return
     cursor = conn.cursor()
@@ -24,15 +186,71 @@ def initialize_database():
         """
         CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
+            title BLOB NOT NULL,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             open_count INTEGER DEFAULT 0,
             max_opens INTEGER DEFAULT NULL,
             expires_at DATETIME DEFAULT NULL,
             is_reflection INTEGER DEFAULT 0,
-            blind_mode INTEGER DEFAULT 0
+            blind_mode INTEGER DEFAULT 0,
+            title_index TEXT DEFAULT NULL,
+            key_id INTEGER NOT NULL DEFAULT 1,
+            wrapped_key BLOB DEFAULT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # Note bodies live apart from the metadata, so list queries never page them in
+        """
+        CREATE TABLE IF NOT EXISTS note_contents (
+            note_id INTEGER PRIMARY KEY,
+            content BLOB NOT NULL,
+            streamed INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # File attachments, always stored as chunked stream envelopes
+        """
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id INTEGER NOT NULL,
+            name BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            content BLOB NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            key_id INTEGER NOT NULL DEFAULT 1,
+            wrapped_key BLOB DEFAULT NULL
+        )
+        """,
+        # Persistent encrypted search index (app/search.py): HMAC tokens -> sealed posting lists
+        """
+        CREATE TABLE IF NOT EXISTS search_postings (
+            token BLOB NOT NULL,
+            bucket INTEGER NOT NULL,
+            postings BLOB NOT NULL,
+            PRIMARY KEY (token, bucket)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS search_note_terms (
+            note_id INTEGER PRIMARY KEY,
+            tokens BLOB NOT NULL
+        )
+        """,
+        # Change feed: a vault-wide revision counter stamped on every note write,
+        # and tombstones for deleted notes (pruned_revision = newest pruned tombstone)
+        """
+        CREATE TABLE IF NOT EXISTS note_revision (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            revision INTEGER NOT NULL DEFAULT 0,
+            pruned_revision INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO note_revision (id) VALUES (1)",
+        """
+        CREATE TABLE IF NOT EXISTS deleted_notes (
+            note_id INTEGER PRIMARY KEY,
+            revision INTEGER NOT NULL,
+            deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         """,
         """
@@ -67,20 +285,116 @@ def initialize_database():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             password_hash TEXT NOT NULL,
             salt TEXT NOT NULL,
-            encrypted_master_key TEXT NOT NULL
+            encrypted_master_key TEXT NOT NULL,
+            format_version INTEGER NOT NULL DEFAULT 1,
+            kdf_algorithm TEXT DEFAULT NULL,
+            kdf_params TEXT DEFAULT NULL,
+            key_id INTEGER NOT NULL DEFAULT 1,
+            index_key TEXT DEFAULT NULL
         )
         """
     ]
 
+    # Columns added after the first release: (table, column, declaration)
+    column_migrations = [
+        ("auth", "format_version", "INTEGER NOT NULL DEFAULT 1"),
+        ("auth", "kdf_algorithm", "TEXT DEFAULT NULL"),
+        ("auth", "kdf_params", "TEXT DEFAULT NULL"),
+        ("notes", "title_index", "TEXT DEFAULT NULL"),
+        ("note_contents", "streamed", "INTEGER NOT NULL DEFAULT 0"),
+        # Master key rotation: which keyring key a row (or the auth record) uses
+        ("auth", "key_id", "INTEGER NOT NULL DEFAULT 1"),
+        ("notes", "key_id", "INTEGER NOT NULL DEFAULT 1"),
+        ("attachments", "key_id", "INTEGER NOT NULL DEFAULT 1"),
+        # Per-row data keys, wrapped under the keyring key; NULL = encrypted directly
+        ("notes", "wrapped_key", "BLOB DEFAULT NULL"),
+        ("attachments", "wrapped_key", "BLOB DEFAULT NULL"),
+        # Blind-index / search key, wrapped under the current master key
+        ("auth", "index_key", "TEXT DEFAULT NULL"),
+        # Change feed: revision of the last write to the note
+        ("notes", "revision", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+    trigger_queries = [
+        # Every way of deleting a note also drops its content
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_notes_delete_content AFTER DELETE ON notes
+        BEGIN
+            DELETE FROM note_contents WHERE note_id = OLD.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_notes_delete_attachments AFTER DELETE ON notes
+        BEGIN
+            DELETE FROM attachments WHERE note_id = OLD.id;
+        END
+        """,
+        # Every write to a note takes the next revision; the WHEN clause keeps the
+        # stamping UPDATE itself from counting as a write
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_notes_revision_insert AFTER INSERT ON notes
+        BEGIN
+            UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+            UPDATE notes SET revision = (SELECT revision FROM note_revision WHERE id = 1) WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_notes_revision_update AFTER UPDATE ON notes
+        WHEN NEW.revision = OLD.revision
+        BEGIN
+            UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+            UPDATE notes SET revision = (SELECT revision FROM note_revision WHERE id = 1) WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_notes_revision_delete AFTER DELETE ON notes
+        BEGIN
+            UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO deleted_notes (note_id, revision)
+            VALUES (OLD.id, (SELECT revision FROM note_revision WHERE id = 1));
+        END
+        """,
+    ]
+
+    index_queries = [
+        # Keyset pagination for list_notes: ORDER BY created_at DESC, id DESC
+        "CREATE INDEX IF NOT EXISTS idx_notes_created ON notes (created_at DESC, id DESC)",
+        # Expiry checks compare julianday(expires_at) (see logic.EXPIRED_SQL)
+        "DROP INDEX IF EXISTS idx_notes_expires",
+        "CREATE INDEX IF NOT EXISTS idx_notes_expires_julianday ON notes (julianday(expires_at)) WHERE expires_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_notes_max_opens ON notes (created_at DESC, id DESC) WHERE max_opens IS NOT NULL",
+        # Expiry sweeper: notes that have used up all their opens
+        "CREATE INDEX IF NOT EXISTS idx_notes_exhausted ON notes (id) WHERE max_opens IS NOT NULL AND open_count >= max_opens",
+        "CREATE INDEX IF NOT EXISTS idx_notes_blind_mode ON notes (blind_mode, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_reflection ON notes (is_reflection, created_at DESC, id DESC)",
+        # Keyed blind index of the title: exact-title lookup and duplicate detection
+        "CREATE INDEX IF NOT EXISTS idx_notes_title_index ON notes (title_index)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_title_index_missing ON notes (id) WHERE title_index IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_attachments_note ON attachments (note_id)",
+        # Key rotation: rows still under an older key
+        "CREATE INDEX IF NOT EXISTS idx_notes_key_id ON notes (key_id)",
+        "CREATE INDEX IF NOT EXISTS idx_attachments_key_id ON attachments (key_id)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_no_data_key ON notes (id) WHERE wrapped_key IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_attachments_no_data_key ON attachments (id) WHERE wrapped_key IS NULL",
+        # Change feed: notes and tombstones newer than a client's last revision
+        "CREATE INDEX IF NOT EXISTS idx_notes_revision ON notes (revision)",
+        "CREATE INDEX IF NOT EXISTS idx_deleted_notes_revision ON deleted_notes (revision)",
+    ]
+
     try:
         for query in table_queries:
             cursor.execute(query)
+        for table, column, declaration in column_migrations:
+            _ensure_column(cursor, table, column, declaration)
+        _split_note_contents(cursor)
+        for query in trigger_queries:
+            cursor.execute(query)
+        for query in index_queries:
+            cursor.execute(query)
         conn.commit()
         print("✅ Tables created successfully (SQLite).")
     except Error as e:
         print(f"❌ Error creating tables: {e}")
     finally:
         cursor.close()
-        conn.close()
-        print("✅ SQLite connection closed.")
 
@@ -1,16 +1,92 @@
 CREATE TABLE IF NOT EXISTS notes (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    content TEXT NOT NULL,
+    title BLOB NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     open_count INTEGER DEFAULT 0,
     max_opens INTEGER DEFAULT NULL,
     expires_at DATETIME DEFAULT NULL,
     is_reflection INTEGER DEFAULT 0,
-    blind_mode INTEGER DEFAULT 0
+    blind_mode INTEGER DEFAULT 0,
+    title_index TEXT DEFAULT NULL,
+    key_id INTEGER NOT NULL DEFAULT 1,
+    wrapped_key BLOB DEFAULT NULL,
+    revision INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE TABLE IF NOT EXISTS note_contents (
+    note_id INTEGER PRIMARY KEY,
+    content BLOB NOT NULL,
+    streamed INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    note_id INTEGER NOT NULL,
+    name BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    content BLOB NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    key_id INTEGER NOT NULL DEFAULT 1,
+    wrapped_key BLOB DEFAULT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_notes_delete_content AFTER DELETE ON notes
+BEGIN
+    DELETE FROM note_contents WHERE note_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_notes_delete_attachments AFTER DELETE ON notes
+BEGIN
+    DELETE FROM attachments WHERE note_id = OLD.id;
+END;
+
+CREATE TABLE IF NOT EXISTS search_postings (
+    token BLOB NOT NULL,
+    bucket INTEGER NOT NULL,
+    postings BLOB NOT NULL,
+    PRIMARY KEY (token, bucket)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS search_note_terms (
+    note_id INTEGER PRIMARY KEY,
+    tokens BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS note_revision (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    revision INTEGER NOT NULL DEFAULT 0,
+    pruned_revision INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO note_revision (id) VALUES (1);
+
+CREATE TABLE IF NOT EXISTS deleted_notes (
+    note_id INTEGER PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_notes_revision_insert AFTER INSERT ON notes
+BEGIN
+    UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+    UPDATE notes SET revision = (SELECT revision FROM note_revision WHERE id = 1) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_notes_revision_update AFTER UPDATE ON notes
+WHEN NEW.revision = OLD.revision
+BEGIN
+    UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+    UPDATE notes SET revision = (SELECT revision FROM note_revision WHERE id = 1) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_notes_revision_delete AFTER DELETE ON notes
+BEGIN
+    UPDATE note_revision SET revision = revision + 1 WHERE id = 1;
+    INSERT OR REPLACE INTO deleted_notes (note_id, revision)
+    VALUES (OLD.id, (SELECT revision FROM note_revision WHERE id = 1));
+END;
+
 CREATE TABLE IF NOT EXISTS settings (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     theme TEXT DEFAULT 'light',
@@ -38,11 +114,26 @@ CREATE TABLE IF NOT EXISTS auth (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     password_hash TEXT NOT NULL,
     salt TEXT NOT NULL,
-    encrypted_master_key TEXT NOT NULL
+    encrypted_master_key TEXT NOT NULL,
+    format_version INTEGER NOT NULL DEFAULT 1,
+    kdf_algorithm TEXT DEFAULT NULL,
+    kdf_params TEXT DEFAULT NULL,
+    key_id INTEGER NOT NULL DEFAULT 1,
+    index_key TEXT DEFAULT NULL
 );
 
-
-
-
-
-
+CREATE INDEX IF NOT EXISTS idx_notes_created ON notes (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notes_expires_julianday ON notes (julianday(expires_at)) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_notes_max_opens ON notes (created_at DESC, id DESC) WHERE max_opens IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_notes_exhausted ON notes (id) WHERE max_opens IS NOT NULL AND open_count >= max_opens;
+CREATE INDEX IF NOT EXISTS idx_notes_blind_mode ON notes (blind_mode, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notes_reflection ON notes (is_reflection, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_notes_title_index ON notes (title_index);
+CREATE INDEX IF NOT EXISTS idx_notes_title_index_missing ON notes (id) WHERE title_index IS NULL;
+CREATE INDEX IF NOT EXISTS idx_attachments_note ON attachments (note_id);
+CREATE INDEX IF NOT EXISTS idx_notes_key_id ON notes (key_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_key_id ON attachments (key_id);
+CREATE INDEX IF NOT EXISTS idx_notes_no_data_key ON notes (id) WHERE wrapped_key IS NULL;
+CREATE INDEX IF NOT EXISTS idx_attachments_no_data_key ON attachments (id) WHERE wrapped_key IS NULL;
+CREATE INDEX IF NOT EXISTS idx_notes_revision ON notes (revision);
+CREATE INDEX IF NOT EXISTS idx_deleted_notes_revision ON deleted_notes (revision);